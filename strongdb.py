@@ -6,6 +6,15 @@ import fcntl
 import termios
 import struct
 import math
+import re
+import mmap
+import bisect
+import threading
+import socket
+import json
+import time
+import atexit
+import collections
 import gdb
 
 sys.path.insert(0, '/Users/cx/source-code/strongdb')
@@ -57,17 +66,34 @@ class Strongdb:
     def init_var(self):
         Strongdb.run_cmd('set $sgdb_stack_width = 4')
         Strongdb.run_cmd('set $sgdb_jnienv = 0')
+        Strongdb.run_cmd('set $sgdb_cache_limit = %d' % ModuleCache.DEFAULT_LIMIT)
         Strongdb.run_cmd('set pagination off')
         Strongdb.run_cmd('set arm abi AAPCS')
 
     def init_handlers(self):
         gdb.events.stop.connect(self.on_stop)
+        gdb.events.cont.connect(self.on_continue)
+        # gdb 7.8+
+        if hasattr(gdb.events, 'memory_changed'):
+            gdb.events.memory_changed.connect(self.on_memory_changed)
+        gdb.events.new_objfile.connect(self.on_new_objfile)
+        gdb.events.exited.connect(self.on_exited)
+        # gdb 7.8+
+        if hasattr(gdb.events, 'before_prompt'):
+            gdb.events.before_prompt.connect(self.on_before_prompt)
+        atexit.register(SnapshotStream.close)
+
+        for objfile in gdb.objfiles():
+            ModuleCache.load_objfile(objfile)
+        atexit.register(ModuleCache.flush)
 
     def init_modules(self):
         self.modules['RegistersModule'] = RegistersModule()
         self.modules['StackModule'] = StackModule()
+        self.modules['WatchModule'] = WatchModule()
         self.modules['AssemblyModule'] = AssemblyModule()
         self.modules['BacktraceModule'] = BacktraceModule()
+        self.modules['ThreadsModule'] = ThreadsModule()
 
     def init_commands(self):
         for cmd in globals().values():
@@ -78,12 +104,51 @@ class Strongdb:
                 pass
 
     def on_continue(self, event):
-        print 'on continue'
+        ThreadsModule.on_continue(event)
+        MemoryCache.invalidate()
+        Heap.invalidate()
+
+    def on_memory_changed(self, event):
+        MemoryCache.invalidate()
+        ModuleCache.invalidate(int(event.address) & 0xffffffffffffffff, int(event.length))
+
+    def on_before_prompt(self):
+        # gdb is idle, hand buffered records to the consumer
+        SnapshotStream.flush()
+        # detach and disconnect leave no live process behind, persist what was learned
+        if gdb.selected_inferior().pid == 0:
+            ModuleCache.flush()
+
+    def on_new_objfile(self, event):
+        MappingIndex.invalidate()
+        ModuleCache.load_objfile(event.new_objfile)
+        ModuleBreakpoints.on_new_objfile(event.new_objfile)
+
+    def on_exited(self, event):
+        MappingIndex.invalidate()
+        MemoryCache.invalidate()
+        Heap.invalidate()
+        Coverage.on_exited(event)
+        ThreadsModule.on_exited(event)
+        ModuleBreakpoints.on_exited(event)
+        SnapshotStream.flush()
+        Patches.on_exited(event)
+        ModuleCache.flush()
 
     def on_stop(self, event):
+        Coverage.on_stop(event)
+
+        if Sampler.is_running and Sampler.on_stop(event):
+            return
+
+        if SnapshotStream.output != None:
+            SnapshotStream.write(self.modules, event)
+            return
+
         Strongdb.display(self.modules['RegistersModule'].get_contents(), True)
         Strongdb.display(self.modules['AssemblyModule'].get_contents())
         Strongdb.display(self.modules['StackModule'].get_contents())
+        Strongdb.display(self.modules['WatchModule'].get_contents())
         Strongdb.display(self.modules['BacktraceModule'].get_contents())
 
     @staticmethod
@@ -96,6 +161,23 @@ class Strongdb:
         else:
             gdb.write(info)
 
+    @staticmethod
+    def save_selection():
+        try:
+            frame = gdb.selected_frame()
+        except gdb.error:
+            frame = None
+        return (gdb.selected_thread(), frame)
+
+    @staticmethod
+    def restore_selection(selection):
+        # switching threads resets the selected frame to #0
+        thread, frame = selection
+        if thread != None and thread.is_valid():
+            thread.switch()
+            if frame != None and frame.is_valid():
+                frame.select()
+
     @staticmethod
     def is_arm_mode():
         value = int(Strongdb.run_cmd('i r cpsr').split(None)[1], 16)
@@ -136,6 +218,645 @@ class Strongdb:
         return Strongdb.colorize('\n└' + '─' * (Strongdb.get_terminal_width() - 2) + '┘', Colors.border_color)
 
 
+# caches
+###############################################
+class MappingIndex():
+    '''Parsed "info proc mapping", indexed by address and by module name.'''
+
+    is_loaded = False
+    regions = []
+    starts = []
+    by_name = {}
+
+    @staticmethod
+    def invalidate():
+        MappingIndex.is_loaded = False
+
+    @staticmethod
+    def load(refresh=False):
+        if MappingIndex.is_loaded and not refresh:
+            return
+
+        MappingIndex.regions = []
+        MappingIndex.starts = []
+        MappingIndex.by_name = {}
+
+        try:
+            mapping = Strongdb.run_cmd('info proc mapping')
+        except gdb.error:
+            # not supported by every target, treat the map as empty
+            mapping = ''
+
+        for line in mapping[mapping.find('0x'):].split('\n'):
+            item = line.split(None)
+            if len(item) < 4 or not item[0].startswith('0x'):
+                continue
+
+            # newer gdb prints a perms column between offset and objfile
+            perms = None
+            path_idx = 4
+            if len(item) > 4 and len(item[4]) == 4 and item[4][0] in 'r-' and item[4][2] in 'x-':
+                perms = item[4]
+                path_idx = 5
+
+            path = ' '.join(item[path_idx:])
+            region = (int(item[0], 16), int(item[1], 16), int(item[3], 16), perms, path)
+            MappingIndex.regions.append(region)
+
+            if path != '':
+                MappingIndex.by_name.setdefault(os.path.basename(path), []).append(region)
+
+        MappingIndex.regions.sort()
+        MappingIndex.starts = [region[0] for region in MappingIndex.regions]
+        MappingIndex.is_loaded = True
+
+        if len(ModuleBreakpoints.pending) != 0:
+            ModuleBreakpoints.on_mapping_loaded()
+
+    @staticmethod
+    def find(addr):
+        MappingIndex.load()
+
+        idx = bisect.bisect_right(MappingIndex.starts, addr) - 1
+        if idx >= 0 and addr < MappingIndex.regions[idx][1]:
+            return MappingIndex.regions[idx]
+        return None
+
+    @staticmethod
+    def module_regions(name):
+        MappingIndex.load()
+        return MappingIndex.by_name.get(name, [])
+
+    @staticmethod
+    def base(name):
+        regions = MappingIndex.module_regions(name)
+        if len(regions) == 0:
+            return None
+        return min([region[0] for region in regions])
+
+
+class MemoryCache():
+    '''Target memory fetched in aligned blocks, valid until the debuggee resumes.'''
+
+    BLOCK_SIZE = 4096
+
+    blocks = {}
+
+    @staticmethod
+    def invalidate():
+        MemoryCache.blocks = {}
+
+    @staticmethod
+    def read(addr, size):
+        '''Return size bytes at addr, fetching each missing run of blocks with a single read.'''
+        first = addr & ~(MemoryCache.BLOCK_SIZE - 1)
+        last = (addr + size - 1) & ~(MemoryCache.BLOCK_SIZE - 1)
+
+        block = first
+        while block <= last:
+            if block in MemoryCache.blocks:
+                block += MemoryCache.BLOCK_SIZE
+                continue
+
+            end = block
+            while end <= last and end not in MemoryCache.blocks:
+                end += MemoryCache.BLOCK_SIZE
+
+            data = str(gdb.selected_inferior().read_memory(block, end - block))
+            for offset in xrange(0, end - block, MemoryCache.BLOCK_SIZE):
+                MemoryCache.blocks[block + offset] = data[offset:offset + MemoryCache.BLOCK_SIZE]
+            block = end
+
+        data = ''.join([MemoryCache.blocks[block] for block in
+                        xrange(first, last + MemoryCache.BLOCK_SIZE, MemoryCache.BLOCK_SIZE)])
+        return data[addr - first:addr - first + size]
+
+
+class ElfFile():
+    '''Minimal ELF reader: build-id, load address and function symbols.'''
+
+    PT_LOAD = 1
+    PT_NOTE = 4
+    SHT_SYMTAB = 2
+    SHT_DYNSYM = 11
+    STT_FUNC = 2
+    NT_GNU_BUILD_ID = 3
+
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        ident = self.f.read(16)
+        if len(ident) != 16 or ident[:4] != '\x7fELF':
+            self.f.close()
+            raise ValueError('%s is not an ELF file' % path)
+
+        self.is64 = ord(ident[4]) == 2
+        self.endian = '<' if ord(ident[5]) == 1 else '>'
+
+        if self.is64:
+            header = self.unpack('HHIQQQIHHHHHH', self.f.read(48))
+            self.phdr_fmt = 'IIQQQQQQ'
+            self.shdr_fmt = 'IIQQQQIIQQ'
+            self.sym_fmt = 'IBBHQQ'
+        else:
+            header = self.unpack('HHIIIIIHHHHHH', self.f.read(36))
+            self.phdr_fmt = 'IIIIIIII'
+            self.shdr_fmt = 'IIIIIIIIII'
+            self.sym_fmt = 'IIIBBH'
+
+        self.machine = header[1]
+        self.phoff, self.shoff = header[4], header[5]
+        self.phentsize, self.phnum = header[8], header[9]
+        self.shentsize, self.shnum = header[10], header[11]
+
+    def close(self):
+        self.f.close()
+
+    def unpack(self, fmt, data, offset=0):
+        return struct.unpack_from(self.endian + fmt, data, offset)
+
+    def read(self, offset, size):
+        self.f.seek(offset)
+        return self.f.read(size)
+
+    def segments(self):
+        data = self.read(self.phoff, self.phentsize * self.phnum)
+        for i in xrange(self.phnum):
+            seg = self.unpack(self.phdr_fmt, data, i * self.phentsize)
+            if self.is64:
+                # type, offset, vaddr, filesz
+                yield (seg[0], seg[2], seg[3], seg[5])
+            else:
+                yield (seg[0], seg[1], seg[2], seg[4])
+
+    def sections(self):
+        data = self.read(self.shoff, self.shentsize * self.shnum)
+        # type, offset, size, link, entsize
+        return [(sec[1], sec[4], sec[5], sec[6], sec[9]) for sec in
+                [self.unpack(self.shdr_fmt, data, i * self.shentsize) for i in xrange(self.shnum)]]
+
+    def load_vaddr(self):
+        loads = [seg[2] for seg in self.segments() if seg[0] == ElfFile.PT_LOAD]
+        if len(loads) == 0:
+            return 0
+        return min(loads) & ~0xfff
+
+    def build_id(self):
+        for seg_type, offset, _, size in self.segments():
+            if seg_type != ElfFile.PT_NOTE:
+                continue
+
+            notes = self.read(offset, size)
+            pos = 0
+            while pos + 12 <= len(notes):
+                namesz, descsz, note_type = self.unpack('III', notes, pos)
+                name_end = pos + 12 + ((namesz + 3) & ~3)
+                if note_type == ElfFile.NT_GNU_BUILD_ID and notes[pos + 12:pos + 15] == 'GNU':
+                    return notes[name_end:name_end + descsz].encode('hex')
+                pos = name_end + ((descsz + 3) & ~3)
+        return None
+
+    def functions(self):
+        '''Return sorted [(value, size, name, is_thumb)], preferring .symtab over .dynsym.'''
+        sections = self.sections()
+        result = {}
+
+        for wanted in (ElfFile.SHT_DYNSYM, ElfFile.SHT_SYMTAB):
+            for sec_type, offset, size, link, entsize in sections:
+                if sec_type != wanted or entsize == 0 or link >= len(sections):
+                    continue
+
+                syms = self.read(offset, size)
+                strtab = self.read(sections[link][1], sections[link][2])
+                for i in xrange(size / entsize):
+                    sym = self.unpack(self.sym_fmt, syms, i * entsize)
+                    if self.is64:
+                        name_off, info, shndx, value, sym_size = sym[0], sym[1], sym[3], sym[4], sym[5]
+                    else:
+                        name_off, value, sym_size, info, shndx = sym[0], sym[1], sym[2], sym[3], sym[5]
+
+                    if (info & 0xf) != ElfFile.STT_FUNC or shndx == 0 or value == 0:
+                        continue
+
+                    name = strtab[name_off:strtab.find('\0', name_off)]
+                    if name == '':
+                        continue
+                    # bit 0 of an ARM function symbol marks Thumb code
+                    is_thumb = self.machine == 40 and bool(value & 1)
+                    result[value & ~1] = (value & ~1, sym_size, name, is_thumb)
+
+        return [result[key] for key in sorted(result.keys())]
+
+
+class ModuleCacheEntry():
+    '''One memory-mapped cache file.
+
+    Layout: header, symbol records sorted by address, disassembly records
+    sorted by address, then a string table that both record kinds point into.
+    '''
+
+    def __init__(self, name, key, path):
+        self.name = name
+        self.key = key
+        self.path = path
+        self.data = None
+        self.new_disasm = {}
+        # (start, end) vaddr ranges patched in memory, their disassembly isn't cached
+        self.patched = []
+        self.open()
+
+    def open(self):
+        with open(self.path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, _, self.load_vaddr, self.sym_count, self.dis_count, _ = \
+            ModuleCache.HEADER.unpack_from(self.data, 0)
+        if magic != ModuleCache.MAGIC or version != ModuleCache.VERSION:
+            self.close()
+            raise ValueError('stale cache file ' + self.path)
+
+        self.sym_offset = ModuleCache.HEADER.size
+        self.dis_offset = self.sym_offset + self.sym_count * ModuleCache.SYMBOL.size
+        self.str_offset = self.dis_offset + self.dis_count * ModuleCache.DISASM.size
+
+        # bump mtime, eviction is least-recently-used first
+        os.utime(self.path, None)
+
+    def close(self):
+        if self.data != None:
+            self.data.close()
+            self.data = None
+
+    def string(self, offset, length=None):
+        start = self.str_offset + offset
+        if length == None:
+            return self.data[start:self.data.find('\0', start)]
+        return self.data[start:start + length]
+
+    def symbol(self, idx):
+        value, size, name_off, flags = ModuleCache.SYMBOL.unpack_from(
+                self.data, self.sym_offset + idx * ModuleCache.SYMBOL.size)
+        return (value, size, self.string(name_off), bool(flags & 1))
+
+    def functions(self):
+        for i in xrange(self.sym_count):
+            yield self.symbol(i)
+
+    def lookup(self, vaddr):
+        '''Return the function symbol that covers vaddr, or None.'''
+        lo, hi = 0, self.sym_count
+        while lo < hi:
+            mid = (lo + hi) / 2
+            if ModuleCache.SYMBOL.unpack_from(self.data, self.sym_offset + mid * ModuleCache.SYMBOL.size)[0] <= vaddr:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo == 0:
+            return None
+
+        sym = self.symbol(lo - 1)
+        if sym[1] != 0 and vaddr >= sym[0] + sym[1]:
+            return None
+        return sym
+
+    def disasm_record(self, idx):
+        return ModuleCache.DISASM.unpack_from(self.data, self.dis_offset + idx * ModuleCache.DISASM.size)
+
+    def is_patched(self, vaddr, length=4):
+        for start, end in self.patched:
+            if vaddr < end and vaddr + length > start:
+                return True
+        return False
+
+    def get_disasm(self, vaddr, is_thumb):
+        '''Return (length, asm) cached for vaddr, or None.'''
+        if self.is_patched(vaddr):
+            return None
+
+        if (vaddr, is_thumb) in self.new_disasm:
+            return self.new_disasm[(vaddr, is_thumb)]
+
+        lo, hi = 0, self.dis_count
+        while lo < hi:
+            mid = (lo + hi) / 2
+            if self.disasm_record(mid)[0] < vaddr:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        while lo < self.dis_count:
+            addr, length, flags, text_len, text_off = self.disasm_record(lo)
+            if addr != vaddr:
+                break
+            if bool(flags & 1) == is_thumb:
+                return (length, self.string(text_off, text_len))
+            lo += 1
+        return None
+
+    def put_disasm(self, vaddr, is_thumb, length, asm):
+        if not self.is_patched(vaddr, length):
+            self.new_disasm[(vaddr, is_thumb)] = (length, asm)
+
+    def invalidate(self, vaddr, size):
+        self.patched.append((vaddr, vaddr + size))
+        for key in self.new_disasm.keys():
+            if self.is_patched(key[0], self.new_disasm[key][0]):
+                del self.new_disasm[key]
+
+    def all_disasm(self):
+        result = {}
+        for i in xrange(self.dis_count):
+            addr, length, flags, text_len, text_off = self.disasm_record(i)
+            result[(addr, bool(flags & 1))] = (length, self.string(text_off, text_len))
+        result.update(self.new_disasm)
+        return result
+
+
+class ModuleCache():
+    '''On-disk per-library analysis cache, keyed by ELF build-id and file size.'''
+
+    MAGIC = 'SGDB'
+    VERSION = 2
+    DEFAULT_LIMIT = 64 * 1024 * 1024
+    # magic, version, flags, load vaddr, symbol count, disasm count, string table size
+    HEADER = struct.Struct('<4sHHQIII')
+    # address, size, name offset, flags (bit 0: thumb)
+    SYMBOL = struct.Struct('<QIIB')
+    # address, insn length, flags (bit 0: thumb), text length, text offset
+    DISASM = struct.Struct('<QBBHI')
+
+    # addresses inside the module are stored as \x01vaddr\x02 so they survive ASLR
+    ADDRESS_RE = re.compile(r'0x[0-9a-fA-F]+')
+    VADDR_RE = re.compile(r'\x01([0-9a-f]+)\x02')
+
+    root = os.path.join(os.path.expanduser('~'), '.strongdb', 'cache')
+    entries = {}
+
+    @staticmethod
+    def get_limit():
+        try:
+            return int(gdb.parse_and_eval('$sgdb_cache_limit'))
+        except gdb.error:
+            return ModuleCache.DEFAULT_LIMIT
+
+    @staticmethod
+    def load_objfile(objfile):
+        filename = objfile.filename
+        if filename == None or not os.path.isfile(filename):
+            return None
+
+        name = os.path.basename(filename)
+        elf = None
+        try:
+            build_id = getattr(objfile, 'build_id', None)
+            if build_id == None:
+                elf = ElfFile(filename)
+                build_id = elf.build_id()
+            if build_id == None:
+                return None
+
+            key = '%s-%x' % (build_id, os.path.getsize(filename))
+            if name in ModuleCache.entries and ModuleCache.entries[name].key == key:
+                return ModuleCache.entries[name]
+
+            path = os.path.join(ModuleCache.root, key + '.sgdb')
+            if os.path.isfile(path):
+                try:
+                    ModuleCache.entries[name] = ModuleCacheEntry(name, key, path)
+                    return ModuleCache.entries[name]
+                except ValueError:
+                    # written by another cache version, build it again
+                    os.remove(path)
+
+            if elf == None:
+                elf = ElfFile(filename)
+            ModuleCache.write(path, elf.load_vaddr(), elf.functions(), {})
+            ModuleCache.evict()
+
+            ModuleCache.entries[name] = ModuleCacheEntry(name, key, path)
+            return ModuleCache.entries[name]
+        except (IOError, OSError, ValueError, struct.error), e:
+            print 'strongdb cache: %s: %s' % (name, e)
+            return None
+        finally:
+            if elf != None:
+                elf.close()
+
+    @staticmethod
+    def write(path, load_vaddr, functions, disasm):
+        strtab = []
+        str_size = 0
+        syms = []
+        for value, size, name, is_thumb in functions:
+            syms.append(ModuleCache.SYMBOL.pack(value, size & 0xffffffff, str_size, 1 if is_thumb else 0))
+            strtab.append(name + '\0')
+            str_size += len(name) + 1
+
+        dis = []
+        for (addr, is_thumb) in sorted(disasm.keys()):
+            length, asm = disasm[(addr, is_thumb)]
+            asm = asm[:0xffff]
+            dis.append(ModuleCache.DISASM.pack(addr, length, 1 if is_thumb else 0, len(asm), str_size))
+            strtab.append(asm)
+            str_size += len(asm)
+
+        if not os.path.isdir(ModuleCache.root):
+            os.makedirs(ModuleCache.root)
+
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(ModuleCache.HEADER.pack(ModuleCache.MAGIC, ModuleCache.VERSION, 0, load_vaddr,
+                                            len(syms), len(dis), str_size))
+            f.write(''.join(syms))
+            f.write(''.join(dis))
+            f.write(''.join(strtab))
+        os.rename(tmp_path, path)
+
+    @staticmethod
+    def flush():
+        written = False
+        for entry in ModuleCache.entries.values():
+            if len(entry.new_disasm) == 0:
+                continue
+
+            try:
+                functions = list(entry.functions())
+                disasm = entry.all_disasm()
+                entry.close()
+                ModuleCache.write(entry.path, entry.load_vaddr, functions, disasm)
+                entry.new_disasm = {}
+                entry.open()
+                written = True
+            except (IOError, OSError, ValueError), e:
+                print 'strongdb cache: %s: %s' % (entry.name, e)
+
+        if written:
+            ModuleCache.evict()
+
+    @staticmethod
+    def evict():
+        if not os.path.isdir(ModuleCache.root):
+            return
+
+        in_use = set([entry.path for entry in ModuleCache.entries.values()])
+        files = []
+        total = 0
+        for name in os.listdir(ModuleCache.root):
+            path = os.path.join(ModuleCache.root, name)
+            # another gdb may be renaming its .tmp files or evicting as well
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        limit = ModuleCache.get_limit()
+        for _, size, path in sorted(files):
+            if total <= limit:
+                break
+            if path in in_use:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    @staticmethod
+    def clear():
+        for entry in ModuleCache.entries.values():
+            entry.close()
+        ModuleCache.entries = {}
+
+        if os.path.isdir(ModuleCache.root):
+            for name in os.listdir(ModuleCache.root):
+                os.remove(os.path.join(ModuleCache.root, name))
+
+    @staticmethod
+    def invalidate(addr, size):
+        entry, vaddr = ModuleCache.resolve(addr)
+        if entry != None:
+            entry.invalidate(vaddr, size)
+
+    @staticmethod
+    def clear_patched():
+        for entry in ModuleCache.entries.values():
+            entry.patched = []
+
+    @staticmethod
+    def resolve(addr):
+        '''Map a runtime address to (entry, vaddr) of its module, or (None, None).'''
+        region = MappingIndex.find(addr)
+        if region == None or region[4] == '':
+            return (None, None)
+
+        name = os.path.basename(region[4])
+        entry = ModuleCache.entries.get(name)
+        if entry == None:
+            return (None, None)
+
+        return (entry, addr - MappingIndex.base(name) + entry.load_vaddr)
+
+    @staticmethod
+    def symbolize(addr):
+        '''Return "module!symbol+off" for addr, falling back to "module+off".'''
+        region = MappingIndex.find(addr)
+        if region == None or region[4] == '':
+            return '??'
+
+        name = os.path.basename(region[4])
+        entry, vaddr = ModuleCache.resolve(addr)
+        if entry != None:
+            sym = entry.lookup(vaddr)
+            if sym != None:
+                if vaddr == sym[0]:
+                    return '%s!%s' % (name, sym[2])
+                return '%s!%s+%#x' % (name, sym[2], vaddr - sym[0])
+
+        return '%s+%#x' % (name, addr - MappingIndex.base(name))
+
+    @staticmethod
+    def disassemble(arch, start, count, is_thumb):
+        '''Disassemble count instructions from start, serving cached module code without touching the target.'''
+        entry, vaddr = ModuleCache.resolve(start)
+        if entry == None:
+            return arch.disassemble(start, count=count)
+
+        # runtime address = vaddr + delta
+        delta = start - vaddr
+        regions = MappingIndex.module_regions(entry.name)
+        low = min([region[0] for region in regions])
+        high = max([region[1] for region in regions])
+
+        def to_vaddr(match):
+            addr = int(match.group(0), 16)
+            if low <= addr < high:
+                return '\x01%x\x02' % (addr - delta)
+            return match.group(0)
+
+        def to_runtime(match):
+            return '%#x' % (int(match.group(1), 16) + delta)
+
+        result = []
+        addr = start
+        while len(result) < count:
+            cached = entry.get_disasm(vaddr + (addr - start), is_thumb)
+            if cached == None:
+                break
+            result.append({'addr': addr, 'asm': ModuleCache.VADDR_RE.sub(to_runtime, cached[1]),
+                           'length': cached[0]})
+            addr += cached[0]
+
+        if len(result) == count:
+            return result
+
+        instructions = arch.disassemble(start, count=count)
+        for ins in instructions:
+            entry.put_disasm(vaddr + (ins['addr'] - start), is_thumb, ins['length'],
+                             ModuleCache.ADDRESS_RE.sub(to_vaddr, ins['asm']))
+        return instructions
+
+
+class Assembler():
+    '''Keystone engines per (arch, mode) and an LRU of assembled snippets.'''
+
+    CACHE_SIZE = 256
+
+    engines = {}
+    snippets = collections.OrderedDict()
+
+    @staticmethod
+    def get_mode(is_thumb=None):
+        if gdb.selected_frame().architecture().name().startswith('aarch64'):
+            return (KS_ARCH_ARM64, KS_MODE_LITTLE_ENDIAN)
+
+        if is_thumb == None:
+            is_thumb = not Strongdb.is_arm_mode()
+        return (KS_ARCH_ARM, KS_MODE_THUMB if is_thumb else KS_MODE_ARM)
+
+    @staticmethod
+    def get_engine(arch, mode):
+        if (arch, mode) not in Assembler.engines:
+            Assembler.engines[(arch, mode)] = Ks(arch, mode)
+        return Assembler.engines[(arch, mode)]
+
+    @staticmethod
+    def assemble(asm, addr, arch, mode):
+        '''Return the machine code of asm placed at addr, raise KsError when it does not assemble.'''
+        key = (arch, mode, asm, addr)
+        code = Assembler.snippets.pop(key, None)
+
+        if code == None:
+            encoding, _ = Assembler.get_engine(arch, mode).asm(asm, addr)
+            code = ''.join([chr(x) for x in encoding or []])
+            if len(Assembler.snippets) >= Assembler.CACHE_SIZE:
+                Assembler.snippets.popitem(last=False)
+
+        Assembler.snippets[key] = code
+        return code
+
+
 # modules
 ###############################################
 class RegistersModule():
@@ -170,6 +891,17 @@ class RegistersModule():
         str += Strongdb.border_footer()
         return str
 
+    def get_regs_snapshot(self):
+        self.get_regs_info()
+
+        registers = {}
+        for reg_name in self.reg_names:
+            value = self.old_regs[reg_name]['value'].strip()
+            registers[reg_name] = int(value, 16) if value.startswith('0x') else value
+
+        return {'registers': registers,
+                'changed': [reg_name for reg_name in self.reg_names if self.old_regs[reg_name]['is_changed']]}
+
     def get_regs_info(self):
         regs = Strongdb.run_cmd("i r").strip().split('\n')
         self.reg_names = []
@@ -200,20 +932,30 @@ class BacktraceModule():
 
         str += Strongdb.border_header('Backtrace')
 
+        frames, stop_reason = self.get_frames()
+        for pc, name in frames:
+            str += '\t%s -> %s()\n' % (Strongdb.colorize(hex(pc)[:-1], Colors.address_color),
+                                       name if name != None else '??')
+
+        str += Strongdb.colorize('\t' + stop_reason, Colors.address_color)
+
+        str += Strongdb.border_footer()
+        return str
+
+    def get_frames(self):
+        frames = []
+
         frame = gdb.selected_frame()
         while frame != None:
-            str += '\t%s -> %s()\n' % (Strongdb.colorize(hex(frame.pc())[:-1], Colors.address_color),
-                                       frame.name() if frame.name() != None else '??')
+            frames.append((frame.pc(), frame.name()))
 
             older_frm = frame.older()
             if older_frm == None:
-                str += Strongdb.colorize('\t' + gdb.frame_stop_reason_string(frame.unwind_stop_reason()),
-                                         Colors.address_color)
+                stop_reason = gdb.frame_stop_reason_string(frame.unwind_stop_reason())
 
             frame = older_frm
 
-        str += Strongdb.border_footer()
-        return str
+        return (frames, stop_reason)
 
 
 class StackModule():
@@ -240,6 +982,10 @@ class StackModule():
         str += Strongdb.border_footer()
         return str
 
+    def get_stack_bytes(self, size):
+        sp = int(gdb.parse_and_eval('$sp')) & 0xffffffffffffffff
+        return (sp, str(gdb.selected_inferior().read_memory(sp, size)))
+
     def get_stack_info(self):
         stack_info = Strongdb.run_cmd('x/48bx $sp').strip().split('\n')
         for line in stack_info:
@@ -253,6 +999,268 @@ class StackModule():
             self.stack_info.append(line_list)
 
 
+class WatchModule():
+    # reads closer than this are fetched together
+    READ_GAP = 4096
+    TYPES = {'char': 'b', 'signed char': 'b', 'unsigned char': 'B', 'short': 'h', 'unsigned short': 'H',
+             'int': 'i', 'unsigned int': 'I', 'unsigned': 'I', 'long long': 'q', 'unsigned long long': 'Q',
+             'int8_t': 'b', 'uint8_t': 'B', 'int16_t': 'h', 'uint16_t': 'H', 'int32_t': 'i', 'uint32_t': 'I',
+             'int64_t': 'q', 'uint64_t': 'Q', 'float': 'f', 'double': 'd'}
+    REG_ALIASES = {'fp': 'r11', 'ip': 'r12'}
+    # *(type*)$reg, *(type*)($reg+off) or *(type*)addr
+    DEREF_RE = re.compile(r'^\*\s*\(\s*([a-z_][a-z0-9_ ]*?)\s*(\*+)\s*\)\s*'
+                          r'(?:\(\s*\$([a-z0-9]+)\s*(?:([+-])\s*(0x[0-9a-f]+|\d+))?\s*\)'
+                          r'|\$([a-z0-9]+)|(0x[0-9a-f]+|\d+))$', re.I)
+    INDEX_RE = re.compile(r'^\$([a-z0-9]+)\s*(?:\[\s*(0x[0-9a-f]+|\d+)\s*\])?$', re.I)
+
+    # [{'expr', 'plan', 'value', 'is_changed'}]
+    watches = []
+
+    def get_contents(self):
+        str = ''
+
+        if len(self.watches) == 0:
+            return str
+
+        str += Strongdb.border_header('Watch')
+
+        self.update_values()
+        for idx in range(len(self.watches)):
+            watch = self.watches[idx]
+            if watch['is_changed']:
+                value = Strongdb.colorize(watch['value'], Colors.reg_value_highlight_color)
+            else:
+                value = Strongdb.colorize(watch['value'], Colors.reg_value_color)
+
+            str += '\t%s %s = %s\n' % (Strongdb.colorize('%d:' % (idx + 1), Colors.address_color), watch['expr'], value)
+
+        str += Strongdb.border_footer()
+        return str
+
+    @staticmethod
+    def compile(expr):
+        '''Return a (register, offset, format, index) plan for simple expressions, or None to use gdb.
+
+        format is None for a bare register value, the register is None for an absolute address.
+        'P' and 'p' stand for unsigned and signed pointer-sized formats, resolved when the plan is
+        evaluated since the target may not be connected yet. index counts elements of that format.
+        '''
+        match = WatchModule.INDEX_RE.match(expr.strip())
+        if match != None:
+            if match.group(2) == None:
+                return (match.group(1).lower(), 0, None, 0)
+            return (match.group(1).lower(), 0, 'P', int(match.group(2), 0))
+
+        match = WatchModule.DEREF_RE.match(expr.strip())
+        if match == None:
+            return None
+
+        type_name, stars, reg, sign, offset, bare_reg, absolute = match.groups()
+        reg = reg or bare_reg
+        type_name = ' '.join(type_name.split())
+        if len(stars) > 1:
+            fmt = 'P'
+        elif type_name in ('long', 'unsigned long', 'size_t', 'uintptr_t', 'intptr_t'):
+            fmt = 'p' if type_name in ('long', 'intptr_t') else 'P'
+        elif type_name in WatchModule.TYPES:
+            fmt = WatchModule.TYPES[type_name]
+        else:
+            return None
+
+        if reg == None:
+            return (None, int(absolute, 0), fmt, 0)
+        offset = int(offset, 0) if offset != None else 0
+        return (reg.lower(), -offset if sign == '-' else offset, fmt, 0)
+
+    @staticmethod
+    def add(expr):
+        WatchModule.watches.append({'expr': expr, 'plan': WatchModule.compile(expr), 'value': '', 'is_changed': False})
+
+    def get_reg(self, name):
+        regs = Strongdb.modules['RegistersModule'].old_regs
+        name = WatchModule.REG_ALIASES.get(name, name) if name not in regs else name
+        return int(regs[name]['value'], 16)
+
+    def update_values(self):
+        values = {}
+        reads = []
+        is64 = gdb.lookup_type('void').pointer().sizeof == 8
+        pointer_formats = {'P': 'Q' if is64 else 'I', 'p': 'q' if is64 else 'i'}
+
+        # registers come from this stop's snapshot
+        for idx in range(len(self.watches)):
+            plan = self.watches[idx]['plan']
+            if plan == None:
+                continue
+
+            try:
+                base = self.get_reg(plan[0]) if plan[0] != None else 0
+            except (KeyError, ValueError):
+                continue
+
+            if plan[2] == None:
+                values[idx] = '%#x' % base
+            else:
+                fmt = '<' + pointer_formats.get(plan[2], plan[2])
+                addr = base + plan[1] + plan[3] * struct.calcsize(fmt)
+                reads.append((addr & 0xffffffffffffffff, idx, fmt))
+
+        # fetch nearby addresses together so the memory cache needs one read per cluster
+        reads.sort()
+        start = 0
+        while start < len(reads):
+            end = start + 1
+            while end < len(reads) and reads[end][0] - reads[end - 1][0] < WatchModule.READ_GAP:
+                end += 1
+
+            first = reads[start][0]
+            last = reads[end - 1][0] + 8
+            try:
+                MemoryCache.read(first, last - first)
+            except gdb.MemoryError:
+                pass
+
+            for addr, idx, fmt in reads[start:end]:
+                try:
+                    value = struct.unpack(fmt, MemoryCache.read(addr, struct.calcsize(fmt)))[0]
+                except gdb.MemoryError:
+                    values[idx] = '<unreadable %#x>' % addr
+                    continue
+                if fmt[1] in 'fd':
+                    values[idx] = '%g' % value
+                else:
+                    values[idx] = '%#x (%d)' % (value & ((1 << (8 * struct.calcsize(fmt))) - 1), value)
+            start = end
+
+        for idx in range(len(self.watches)):
+            watch = self.watches[idx]
+            if idx not in values:
+                try:
+                    values[idx] = str(gdb.parse_and_eval(watch['expr']))
+                except gdb.error, e:
+                    values[idx] = '<%s>' % e
+
+            watch['is_changed'] = watch['value'] != '' and watch['value'] != values[idx]
+            watch['value'] = values[idx]
+
+
+class ThreadsModule():
+    # tid -> {'name', 'pc', 'where', 'dirty'}
+    threads = {}
+    # pid -> whether the debuggee runs on this host
+    native = {}
+
+    def get_contents(self):
+        str = ''
+
+        str += Strongdb.border_header('Threads')
+
+        for thread, info in self.get_threads_info():
+            if thread.is_exited():
+                state = 'exited'
+            elif thread.is_running():
+                state = 'running'
+            else:
+                state = 'stopped'
+
+            if thread == gdb.selected_thread():
+                str += Strongdb.colorize('-->', Colors.code_highlight_color)
+            str += '\t%3d  %-7d %-16s ' % (thread.num, ThreadsModule.get_tid(thread), info['name'][:16])
+            if info['pc'] != None:
+                str += Strongdb.colorize('0x%08x' % info['pc'], Colors.address_color)
+            else:
+                str += '?' * 10
+            str += '  %-8s %s\n' % (state, info['where'])
+
+        str += Strongdb.border_footer()
+        return str
+
+    @staticmethod
+    def get_tid(thread):
+        return thread.ptid[1] if thread.ptid[1] != 0 else thread.ptid[2]
+
+    @staticmethod
+    def on_continue(event):
+        # in all-stop mode every thread resumes, in non-stop mode only the given one
+        thread = getattr(event, 'inferior_thread', None)
+        if thread == None:
+            for info in ThreadsModule.threads.values():
+                info['dirty'] = True
+        else:
+            info = ThreadsModule.threads.get(ThreadsModule.get_tid(thread))
+            if info != None:
+                info['dirty'] = True
+
+    @staticmethod
+    def on_exited(event):
+        ThreadsModule.threads = {}
+        ThreadsModule.native = {}
+
+    def get_threads_info(self):
+        inferior = gdb.selected_inferior()
+        selection = Strongdb.save_selection()
+        result = []
+        alive = set()
+
+        try:
+            for thread in sorted(inferior.threads(), key=lambda thread: thread.num):
+                tid = ThreadsModule.get_tid(thread)
+                alive.add(tid)
+
+                info = self.threads.get(tid)
+                if info == None:
+                    info = {'name': self.get_thread_name(inferior, tid, thread), 'pc': None, 'where': '',
+                            'dirty': True}
+                    self.threads[tid] = info
+
+                if info['dirty'] and thread.is_stopped():
+                    # a single $pc read per thread, no frame unwinding
+                    thread.switch()
+                    try:
+                        info['pc'] = int(gdb.parse_and_eval('$pc')) & 0xffffffffffffffff
+                        info['where'] = ModuleCache.symbolize(info['pc'])
+                    except gdb.error:
+                        info['pc'] = None
+                        info['where'] = ''
+                    info['dirty'] = False
+
+                result.append((thread, info))
+        finally:
+            Strongdb.restore_selection(selection)
+
+        for tid in self.threads.keys():
+            if tid not in alive:
+                del self.threads[tid]
+
+        return result
+
+    @staticmethod
+    def is_native(inferior):
+        # asked once per process, 'info target' is a round trip on older gdb
+        if inferior.pid not in ThreadsModule.native:
+            # gdb 11+
+            connection = getattr(inferior, 'connection', None)
+            if connection != None:
+                ThreadsModule.native[inferior.pid] = connection.type == 'native'
+            else:
+                ThreadsModule.native[inferior.pid] = 'remote' not in Strongdb.run_cmd('info target').lower()
+        return ThreadsModule.native[inferior.pid]
+
+    def get_thread_name(self, inferior, tid, thread):
+        if thread.name != None:
+            return thread.name
+
+        # the host's /proc only describes the debuggee when it runs locally
+        if not ThreadsModule.is_native(inferior):
+            return ''
+
+        try:
+            with open('/proc/%d/task/%d/comm' % (inferior.pid, tid)) as f:
+                return f.read().strip()
+        except IOError:
+            return ''
+
+
 class JniNativeInterface():
     is_loaded = False
     func_address = {}
@@ -500,34 +1508,15 @@ class AssemblyModule():
         str = ""
         str += Strongdb.border_header('Assembly')
 
-        if Strongdb.is_arm_mode():
-            length_per_ins = 4
-        else:
-            length_per_ins = 2
-
-        frame = gdb.selected_frame()
-        instructions = frame.architecture().disassemble(frame.pc() - 4 * length_per_ins, count=10)
-
-        self.load_jni_native_table()
-
-        for ins in instructions:
-            if frame.pc() == ins['addr']:
+        pc = gdb.selected_frame().pc()
+        for ins in self.get_instructions():
+            if pc == ins['addr']:
                 str += Strongdb.colorize('-->\t' + hex(ins['addr'])[:-1] + ':\t', Colors.address_color)
                 str += Strongdb.colorize(self.get_machine_code(ins['asm']), Colors.code_highlight_color)
 
-                jni_func = ""
-
-                # get JNIEnv pointer
-                jni_env_addr = self.get_jni_env_addr()
-                # check blx rx
-                if jni_env_addr != 0 and ins['asm'].lower().startswith('blx\tr'):
-                    reg = ins['asm'][4:]
-
-                    called_addr = Strongdb.run_cmd('i r $' + reg).split(None)[1]
-
-                    # if the address is in JniNativeInterface address table
-                    if self.jni_env.func_address[called_addr] != None:
-                        jni_func = "; " + self.jni_env.func_address[called_addr]
+                jni_func = self.get_jni_func(ins)
+                if jni_func != "":
+                    jni_func = "; " + jni_func
 
                 str += Strongdb.colorize(ins['asm'] + '\t' + Strongdb.colorize(jni_func, 'yellow'),
                                          Colors.code_highlight_color) + '\n'
@@ -539,20 +1528,46 @@ class AssemblyModule():
         str += Strongdb.border_footer()
         return str
 
-    def get_machine_code(self, asm):
-        if Strongdb.is_arm_mode():
-            ks = Ks(KS_ARCH_ARM, KS_MODE_ARM)
+    def get_instructions(self):
+        is_arm_mode = Strongdb.is_arm_mode()
+        if is_arm_mode:
+            length_per_ins = 4
         else:
-            ks = Ks(KS_ARCH_ARM, KS_MODE_THUMB)
+            length_per_ins = 2
+
+        frame = gdb.selected_frame()
+        instructions = ModuleCache.disassemble(frame.architecture(), frame.pc() - 4 * length_per_ins, 10,
+                                               not is_arm_mode)
+
+        self.load_jni_native_table()
+        return instructions
+
+    def get_jni_func(self, ins):
+        # get JNIEnv pointer
+        jni_env_addr = self.get_jni_env_addr()
+        # check blx rx
+        if jni_env_addr != 0 and ins['asm'].lower().startswith('blx\tr'):
+            reg = ins['asm'][4:]
+
+            called_addr = Strongdb.run_cmd('i r $' + reg).split(None)[1]
+
+            # if the address is in JniNativeInterface address table
+            if self.jni_env.func_address.get(called_addr) != None:
+                return self.jni_env.func_address[called_addr]
+
+        return ""
+
+    def get_machine_code(self, asm):
+        arch, mode = Assembler.get_mode()
+
+        if asm.find(';') != -1:
+            asm = asm[:asm.find(';')]
 
         try:
-            if asm.find(';') == -1:
-                mc, _ = ks.asm(asm)
-            else:
-                mc, _ = ks.asm(asm[:asm.find(';')])
-        except:
-            print 'fucked'
-        return ' '.join([hex(x)[2:].rjust(2, '0') for x in mc]) + '\t'
+            mc = Assembler.assemble(asm, 0, arch, mode)
+        except KsError:
+            mc = ''
+        return ' '.join([hex(ord(x))[2:].rjust(2, '0') for x in mc]) + '\t'
 
     def load_jni_native_table(self):
         jni_env_addr = self.get_jni_env_addr()
@@ -574,67 +1589,1046 @@ class AssemblyModule():
         return jni_env_addr
 
 
-# commands
+# profiling
 ###############################################
-class MappingCommand(gdb.Command):
-    '''List of mapped memory regions.'''
+class Sampler():
+    '''Poor-man's sampling profiler built on interrupt/continue.'''
+
+    is_running = False
+    interval = 0.05
+    remaining = 0
+    depth = 16
+    timer = None
+    samples = 0
+    # node: [inclusive count, self count, {name: node}]
+    tree = [0, 0, {}]
+    symbols = {}
 
-    def __init__(self):
-        gdb.Command.__init__(self, 'vmmap', gdb.COMMAND_RUNNING, prefix=True)
-        self.init_subcommands()
+    @staticmethod
+    def start(rate, count, depth):
+        Sampler.interval = 1.0 / rate
+        Sampler.remaining = count
+        Sampler.depth = depth
+        Sampler.is_running = True
+        Sampler.resume()
 
-    def init_subcommands(self):
-        MappingCommand.MappingFilterCommand()
+    @staticmethod
+    def stop():
+        if Sampler.timer != None:
+            Sampler.timer.cancel()
+            Sampler.timer = None
+        Sampler.is_running = False
 
-    def invoke(self, args, from_tty):
-        try:
-            mapping = Strongdb.run_cmd('info proc mapping')
-            Strongdb.display(mapping)
-        except Exception, e:
-            print e
-            return
+    @staticmethod
+    def reset():
+        Sampler.samples = 0
+        Sampler.tree = [0, 0, {}]
+        Sampler.symbols = {}
 
-    # subcommands
+    @staticmethod
+    def resume():
+        if not Sampler.is_running:
+            return
 
-    class MappingFilterCommand(gdb.Command):
-        '''Memory region of specific module'''
+        gdb.execute('continue &')
+        Sampler.timer = threading.Timer(Sampler.interval, gdb.post_event, [Sampler.interrupt])
+        Sampler.timer.daemon = True
+        Sampler.timer.start()
 
-        def __init__(self):
-            gdb.Command.__init__(self, 'vmmap -f', gdb.COMMAND_NONE)
+    @staticmethod
+    def interrupt():
+        if Sampler.is_running:
+            gdb.execute('interrupt')
 
-        def invoke(self, args, from_tty):
-            argv = gdb.string_to_argv(args)
-            result = []
+    @staticmethod
+    def on_stop(event):
+        '''Record a sample; return False when the stop was not ours and should be rendered.'''
+        if not isinstance(event, gdb.SignalEvent) or event.stop_signal not in ('SIGINT', '0'):
+            Sampler.stop()
+            return False
+
+        Sampler.record()
+        Sampler.remaining -= 1
+        if Sampler.remaining <= 0:
+            Sampler.stop()
+            Strongdb.display('sampling done, %d samples\n' % Sampler.samples)
+        else:
+            gdb.post_event(Sampler.resume)
+        return True
 
-            if len(argv) != 1:
-                raise gdb.GdbError('vmmap -f takes 1 arg')
+    @staticmethod
+    def symbolize(pc):
+        if pc not in Sampler.symbols:
+            Sampler.symbols[pc] = ModuleCache.symbolize(pc).split('+')[0]
+        return Sampler.symbols[pc]
 
+    @staticmethod
+    def record():
+        selection = Strongdb.save_selection()
+        for thread in gdb.selected_inferior().threads():
             try:
-                mapping = Strongdb.run_cmd('info proc mapping')
-                mapping = mapping[mapping.find('0x'):].split('\n')
+                thread.switch()
+                frame = gdb.newest_frame()
+                stack = []
+                while frame != None and len(stack) < Sampler.depth:
+                    stack.append(Sampler.symbolize(frame.pc()))
+                    frame = frame.older()
+            except gdb.error:
+                continue
+
+            node = Sampler.tree
+            node[0] += 1
+            for name in reversed(stack):
+                node = node[2].setdefault(name, [0, 0, {}])
+                node[0] += 1
+            node[1] += 1
+            Sampler.samples += 1
+
+        Strongdb.restore_selection(selection)
 
-                for item in mapping:
-                    item_list = item.split(None)
+    @staticmethod
+    def top(n):
+        '''Return [(name, self count, inclusive count)] of the n hottest symbols.'''
+        self_counts = {}
+        inclusive = {}
+
+        def walk(node, path):
+            for name, child in node[2].items():
+                self_counts[name] = self_counts.get(name, 0) + child[1]
+                # count a recursive symbol once per stack
+                if name not in path:
+                    inclusive[name] = inclusive.get(name, 0) + child[0]
+                walk(child, path | set([name]))
+
+        walk(Sampler.tree, set())
+        names = sorted(self_counts.keys(), key=lambda name: (-self_counts[name], -inclusive[name]))
+        return [(name, self_counts[name], inclusive[name]) for name in names[:n]]
 
-                    if len(item_list) == 5 and item_list[4].find(argv[0]) != -1:
-                        result.append('\t\t'.join(item_list))
+    @staticmethod
+    def folded():
+        '''Yield "a;b;c count" lines for flamegraph.pl.'''
+        stack = [([], Sampler.tree)]
+        while len(stack) != 0:
+            path, node = stack.pop()
+            if node[1] != 0 and len(path) != 0:
+                yield '%s %d' % (';'.join(path), node[1])
+            for name, child in node[2].items():
+                stack.append((path + [name], child))
+
+
+# coverage
+###############################################
+class CoverageBreakpoint(gdb.Breakpoint):
+    '''Internal breakpoint that records a basic block hit and never stops.'''
+
+    def __init__(self, addr, idx):
+        gdb.Breakpoint.__init__(self, '*%#x' % addr, internal=True)
+        self.idx = idx
+
+    def stop(self):
+        Coverage.hit(self)
+        return False
+
+
+class Coverage():
+    '''Basic block coverage of one module, exported in drcov format.'''
+
+    BATCH_SIZE = 512
+    CONDITIONS = ('eq', 'ne', 'cs', 'hs', 'cc', 'lo', 'mi', 'pl', 'vs', 'vc', 'hi', 'ls', 'ge', 'lt', 'gt', 'le', 'al')
+    BRANCHES = ('b', 'bl', 'blx', 'bx', 'br', 'blr', 'ret', 'cbz', 'cbnz', 'tbz', 'tbnz', 'tbb', 'tbh')
+    # drcov basic block entry: start offset, size, module id
+    BB_ENTRY = struct.Struct('<IHH')
+
+    name = None
+    path = None
+    base = 0
+    end = 0
+    # [(offset from base, size)] sorted by offset
+    blocks = []
+    bitmap = bytearray()
+    hit_count = 0
+    breakpoints = {}
+    retired = []
+    # index of the next block to arm, and a counter that cancels posted batches
+    installed = 0
+    generation = 0
 
-                Strongdb.display('\n'.join(result) + '\n\n')
-            except Exception, e:
-                print e
-                return
+    @staticmethod
+    def is_branch(asm):
+        parts = asm.split(None, 1)
+        if len(parts) == 0:
+            return False
 
+        mnemonic = parts[0].lower().split('.')[0]
+        operands = parts[1].lower() if len(parts) == 2 else ''
 
-class ColorCommand(gdb.Command):
-    '''Set views color'''
+        for branch in Coverage.BRANCHES:
+            if mnemonic == branch or (mnemonic.startswith(branch) and mnemonic[len(branch):] in Coverage.CONDITIONS):
+                return True
 
-    def __init__(self):
-        gdb.Command.__init__(self, 'color', gdb.COMMAND_USER, prefix=True)
-        self.init_subcommands()
+        # writes to pc: pop {..., pc}, ldr pc, [...], mov pc, lr
+        if mnemonic.startswith('pop') or mnemonic.startswith('ldm'):
+            return 'pc}' in operands.replace(' ', '')
+        return operands.startswith('pc,')
 
-    def init_subcommands(self):
-        ColorCommand.ColorBorderCommand()
-        ColorCommand.ColorRegNameCommand()
+    @staticmethod
+    def branch_target(asm):
+        for token in asm.replace(',', ' ').split(None)[1:]:
+            if token.startswith('0x'):
+                try:
+                    return int(token, 16)
+                except ValueError:
+                    return None
+        return None
+
+    @staticmethod
+    def find_leaders(arch, start, end, is_thumb):
+        '''Disassemble [start, end) and return the basic block leaders inside it.'''
+        is_arm = arch.name().startswith('arm')
+        if is_arm:
+            Strongdb.run_cmd('set arm force-mode %s' % ('thumb' if is_thumb else 'arm'))
+
+        try:
+            instructions = arch.disassemble(start, end - 1)
+        finally:
+            if is_arm:
+                Strongdb.run_cmd('set arm force-mode auto')
+
+        leaders = set([start])
+        for ins in instructions:
+            if not Coverage.is_branch(ins['asm']):
+                continue
+
+            leaders.add(ins['addr'] + ins['length'])
+            target = Coverage.branch_target(ins['asm'])
+            if target != None:
+                leaders.add(target)
+
+        return set([addr for addr in leaders if start <= addr < end])
+
+    @staticmethod
+    def find_blocks(name):
+        regions = MappingIndex.module_regions(name)
+        code = [region for region in regions if region[3] != None and 'x' in region[3]]
+        if len(code) == 0:
+            # no perms column in older gdb, the text segment is mapped first
+            code = [region for region in regions if region[2] == 0][:1]
+        if len(code) == 0:
+            raise gdb.GdbError('no executable mapping for ' + name)
+
+        base = MappingIndex.base(name)
+        arch = gdb.selected_frame().architecture()
+        is_thumb = not Strongdb.is_arm_mode()
+
+        # function boundaries from the module cache carry the ARM/Thumb mode
+        functions = []
+        entry = ModuleCache.entries.get(name)
+        if entry != None:
+            for value, size, _, thumb in entry.functions():
+                addr = base + value - entry.load_vaddr
+                if size != 0:
+                    functions.append((addr, addr + size, thumb))
+        functions.sort()
+
+        # code outside any sized symbol is disassembled in the current mode
+        ranges = []
+        for region in code:
+            cursor = region[0]
+            for start, end, thumb in functions:
+                start, end = max(start, cursor), min(end, region[1])
+                if start >= end:
+                    continue
+                if start > cursor:
+                    ranges.append((cursor, start, is_thumb))
+                ranges.append((start, end, thumb))
+                cursor = end
+            if cursor < region[1]:
+                ranges.append((cursor, region[1], is_thumb))
+
+        blocks = []
+        for start, end, thumb in ranges:
+            leaders = sorted(Coverage.find_leaders(arch, start, end, thumb)) + [end]
+            for i in xrange(len(leaders) - 1):
+                blocks.append((leaders[i] - base, min(leaders[i + 1] - leaders[i], 0xffff)))
+
+        return (base, max([region[1] for region in regions]), code[0][4], sorted(set(blocks)))
+
+    @staticmethod
+    def start(name):
+        Coverage.stop()
+        Coverage.base, Coverage.end, Coverage.path, Coverage.blocks = Coverage.find_blocks(name)
+        Coverage.name = name
+        Coverage.installed = 0
+        Coverage.bitmap = bytearray((len(Coverage.blocks) + 7) / 8)
+        Coverage.hit_count = 0
+        Coverage.install_batch(Coverage.generation)
+
+    @staticmethod
+    def install_batch(generation):
+        '''Arm the next BATCH_SIZE blocks, the rest is posted so gdb keeps handling input in between.'''
+        if generation != Coverage.generation or Coverage.installed >= len(Coverage.blocks):
+            return
+
+        # breakpoints can't be added while the debuggee runs, on_stop picks up from here
+        thread = gdb.selected_thread()
+        if thread != None and thread.is_running():
+            return
+
+        end = min(Coverage.installed + Coverage.BATCH_SIZE, len(Coverage.blocks))
+        for idx in xrange(Coverage.installed, end):
+            Coverage.breakpoints[idx] = CoverageBreakpoint(Coverage.base + Coverage.blocks[idx][0], idx)
+        Coverage.installed = end
+
+        if end < len(Coverage.blocks):
+            gdb.post_event(lambda: Coverage.install_batch(generation))
+
+    @staticmethod
+    def on_stop(event):
+        if Coverage.name != None and Coverage.installed < len(Coverage.blocks):
+            Coverage.install_batch(Coverage.generation)
+
+    @staticmethod
+    def on_exited(event):
+        # the breakpoints die with the process, the bitmap stays exportable
+        Coverage.stop()
+
+    @staticmethod
+    def stop():
+        # drop batches that are still posted
+        Coverage.generation += 1
+        Coverage.installed = len(Coverage.blocks)
+
+        for bp in Coverage.breakpoints.values():
+            if bp.is_valid():
+                bp.delete()
+        Coverage.breakpoints = {}
+        Coverage.retired = []
+
+    @staticmethod
+    def hit(bp):
+        idx = bp.idx
+        if Coverage.bitmap[idx >> 3] & (1 << (idx & 7)):
+            return
+
+        Coverage.bitmap[idx >> 3] |= 1 << (idx & 7)
+        Coverage.hit_count += 1
+
+        # breakpoints can't be deleted from their own stop(), retire them in bulk
+        if len(Coverage.retired) == 0:
+            gdb.post_event(Coverage.retire)
+        Coverage.retired.append(bp)
+
+    @staticmethod
+    def retire():
+        for bp in Coverage.retired:
+            Coverage.breakpoints.pop(bp.idx, None)
+            if bp.is_valid():
+                bp.delete()
+        Coverage.retired = []
+
+    @staticmethod
+    def export(filename):
+        hits = [Coverage.blocks[idx] for idx in xrange(len(Coverage.blocks))
+                if Coverage.bitmap[idx >> 3] & (1 << (idx & 7))]
+
+        with open(filename, 'wb') as f:
+            f.write('DRCOV VERSION: 2\n')
+            f.write('DRCOV FLAVOR: strongdb\n')
+            f.write('Module Table: version 2, count 1\n')
+            f.write('Columns: id, base, end, entry, checksum, timestamp, path\n')
+            f.write(' 0, %#018x, %#018x, 0x0000000000000000, 0x00000000, 0x00000000, %s\n' % (
+                Coverage.base, Coverage.end, Coverage.path))
+            f.write('BB Table: %d bbs\n' % len(hits))
+            f.write(''.join([Coverage.BB_ENTRY.pack(offset, size, 0) for offset, size in hits]))
+
+
+# breakpoints
+###############################################
+class ModuleBreakpoints():
+    '''Breakpoints at library+offset, armed whenever the library gets mapped.'''
+
+    # library name -> [{'id', 'offset', 'bp'}]
+    pending = {}
+    next_id = 1
+
+    @staticmethod
+    def add(name, offset):
+        entry = {'id': ModuleBreakpoints.next_id, 'offset': offset, 'bp': None}
+        ModuleBreakpoints.next_id += 1
+        ModuleBreakpoints.pending.setdefault(name, []).append(entry)
+
+        if gdb.selected_inferior().pid != 0:
+            ModuleBreakpoints.resolve(name)
+        return entry
+
+    @staticmethod
+    def delete(entry_id):
+        for name, entries in ModuleBreakpoints.pending.items():
+            for entry in entries:
+                if entry['id'] != entry_id:
+                    continue
+
+                if entry['bp'] != None and entry['bp'].is_valid():
+                    entry['bp'].delete()
+                entries.remove(entry)
+                if len(entries) == 0:
+                    del ModuleBreakpoints.pending[name]
+                return True
+        return False
+
+    @staticmethod
+    def resolve(name):
+        entries = ModuleBreakpoints.pending.get(name)
+        if entries == None:
+            return
+
+        unarmed = [entry for entry in entries if entry['bp'] == None or not entry['bp'].is_valid()]
+        if len(unarmed) == 0:
+            return
+
+        # may reload the mapping index, which re-enters resolve()
+        base = MappingIndex.base(name)
+        if base == None:
+            return
+
+        for entry in unarmed:
+            if entry['bp'] == None or not entry['bp'].is_valid():
+                # an odd offset marks Thumb code, gdb then inserts a Thumb breakpoint
+                entry['bp'] = gdb.Breakpoint('*%#x' % (base + entry['offset']))
+
+    @staticmethod
+    def on_new_objfile(objfile):
+        if objfile.filename != None:
+            ModuleBreakpoints.resolve(os.path.basename(objfile.filename))
+
+    @staticmethod
+    def on_mapping_loaded():
+        for name in ModuleBreakpoints.pending.keys():
+            if name in MappingIndex.by_name:
+                ModuleBreakpoints.resolve(name)
+
+    @staticmethod
+    def on_exited(event):
+        # the next run maps the libraries elsewhere, wait for them again
+        for entries in ModuleBreakpoints.pending.values():
+            for entry in entries:
+                if entry['bp'] != None and entry['bp'].is_valid():
+                    entry['bp'].delete()
+                entry['bp'] = None
+
+
+# snapshots
+###############################################
+class SnapshotStream():
+    '''Headless mode: one structured record per stop instead of the views.'''
+
+    BUFFER_SIZE = 64 * 1024
+    STACK_SIZE = 48
+    BIN_VERSION = 1
+    # binary records, little-endian: u32 length of the rest of the record, u16 version, u32 seq,
+    # f64 time, u64 pc, u64 sp, u16 stack length, the raw stack bytes, then the remaining
+    # fields as a UTF-8 JSON object up to the end of the record
+    RECORD_HEADER = struct.Struct('<IHIdQQH')
+
+    output = None
+    sock = None
+    format = 'json'
+    target = None
+    count = 0
+
+    @staticmethod
+    def open(target, fmt, is_socket):
+        SnapshotStream.close()
+
+        if is_socket:
+            SnapshotStream.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            SnapshotStream.sock.connect(target)
+            SnapshotStream.output = SnapshotStream.sock.makefile('wb', SnapshotStream.BUFFER_SIZE)
+        else:
+            SnapshotStream.output = open(target, 'ab', SnapshotStream.BUFFER_SIZE)
+
+        SnapshotStream.format = fmt
+        SnapshotStream.target = target
+        SnapshotStream.count = 0
+
+    @staticmethod
+    def close():
+        if SnapshotStream.output != None:
+            try:
+                SnapshotStream.output.close()
+            except (IOError, socket.error):
+                pass
+            SnapshotStream.output = None
+
+        if SnapshotStream.sock != None:
+            SnapshotStream.sock.close()
+            SnapshotStream.sock = None
+
+    @staticmethod
+    def flush():
+        if SnapshotStream.output != None:
+            try:
+                SnapshotStream.output.flush()
+            except (IOError, socket.error), e:
+                print 'strongdb snapshot: %s, stopped streaming' % e
+                SnapshotStream.close()
+
+    @staticmethod
+    def get_record(modules, event):
+        regs = modules['RegistersModule'].get_regs_snapshot()
+        thread = gdb.selected_thread()
+        frame = gdb.selected_frame()
+
+        sp, stack = modules['StackModule'].get_stack_bytes(SnapshotStream.STACK_SIZE)
+        assembly = modules['AssemblyModule']
+        instructions = assembly.get_instructions()
+        frames, stop_reason = modules['BacktraceModule'].get_frames()
+
+        record = {
+            'seq': SnapshotStream.count,
+            'time': time.time(),
+            'tid': ThreadsModule.get_tid(thread) if thread != None else 0,
+            'pc': frame.pc(),
+            'registers': regs['registers'],
+            'changed': regs['changed'],
+            'sp': sp,
+            'stack': stack.encode('hex'),
+            'disassembly': [{'addr': ins['addr'], 'length': ins['length'], 'asm': ins['asm']}
+                            for ins in instructions],
+            'backtrace': [{'pc': pc, 'name': name} for pc, name in frames],
+            'unwind_stop_reason': stop_reason,
+            'jni': None,
+        }
+
+        watch = modules['WatchModule']
+        if len(watch.watches) != 0:
+            watch.update_values()
+            record['watches'] = [{'expr': item['expr'], 'value': item['value'], 'is_changed': item['is_changed']}
+                                 for item in watch.watches]
+
+        if isinstance(event, gdb.SignalEvent):
+            record['signal'] = event.stop_signal
+        elif isinstance(event, gdb.BreakpointEvent):
+            record['breakpoints'] = [bp.number for bp in event.breakpoints]
+
+        for ins in instructions:
+            if ins['addr'] == frame.pc():
+                record['jni'] = assembly.get_jni_func(ins) or None
+
+        return record
+
+    @staticmethod
+    def pack(record):
+        fields = dict(record)
+        stack = fields.pop('stack').decode('hex')
+        header = [fields.pop(name) for name in ('seq', 'time', 'pc', 'sp')]
+        data = json.dumps(fields, separators=(',', ':'))
+
+        length = SnapshotStream.RECORD_HEADER.size - 4 + len(stack) + len(data)
+        return SnapshotStream.RECORD_HEADER.pack(length, SnapshotStream.BIN_VERSION, header[0], header[1],
+                                                 header[2], header[3], len(stack)) + stack + data
+
+    @staticmethod
+    def write(modules, event):
+        record = SnapshotStream.get_record(modules, event)
+
+        try:
+            if SnapshotStream.format == 'json':
+                SnapshotStream.output.write(json.dumps(record, separators=(',', ':')) + '\n')
+            else:
+                SnapshotStream.output.write(SnapshotStream.pack(record))
+        except (IOError, socket.error), e:
+            print 'strongdb snapshot: %s, stopped streaming' % e
+            SnapshotStream.close()
+            return
+
+        SnapshotStream.count += 1
+
+
+# patches
+###############################################
+class Patches():
+    '''Code patches with their original bytes, kept module-relative so they can be replayed.'''
+
+    # [{'id', 'addr', 'module', 'offset', 'asm', 'mode', 'original', 'code', 'is_applied'}]
+    patches = []
+    next_id = 1
+
+    @staticmethod
+    def locate(addr):
+        region = MappingIndex.find(addr)
+        if region == None or region[4] == '':
+            return (None, addr)
+
+        name = os.path.basename(region[4])
+        return (name, addr - MappingIndex.base(name))
+
+    @staticmethod
+    def write(addr, code):
+        gdb.selected_inferior().write_memory(addr, code)
+        ModuleCache.invalidate(addr, len(code))
+        MemoryCache.invalidate()
+
+    @staticmethod
+    def apply(addr, asm, mode):
+        if mode[1] == KS_MODE_THUMB:
+            addr &= ~1
+
+        code = Assembler.assemble(asm, addr, mode[0], mode[1])
+        if len(code) == 0:
+            raise gdb.GdbError('nothing to patch')
+
+        original = str(gdb.selected_inferior().read_memory(addr, len(code)))
+        Patches.write(addr, code)
+
+        module, offset = Patches.locate(addr)
+        patch = {'id': Patches.next_id, 'addr': addr, 'module': module, 'offset': offset, 'asm': asm,
+                 'mode': mode, 'original': original, 'code': code, 'is_applied': True}
+        Patches.next_id += 1
+        Patches.patches.append(patch)
+        return patch
+
+    @staticmethod
+    def undo(patch_id):
+        for patch in Patches.patches:
+            if patch['id'] != patch_id:
+                continue
+
+            # later patches saved our bytes as their original, undo them first
+            idx = Patches.patches.index(patch)
+            end = patch['addr'] + len(patch['code'])
+            for later in Patches.patches[idx + 1:]:
+                if later['is_applied'] and later['addr'] < end and patch['addr'] < later['addr'] + len(later['code']):
+                    raise gdb.GdbError('patch %d overlaps patch %d, undo it first' % (later['id'], patch_id))
+
+            if patch['is_applied']:
+                Patches.write(patch['addr'], patch['original'])
+            Patches.patches.remove(patch)
+            return True
+        return False
+
+    @staticmethod
+    def replay():
+        '''Re-apply patches lost by a restart, return how many were applied.'''
+        count = 0
+        for patch in Patches.patches:
+            if patch['is_applied']:
+                continue
+
+            if patch['module'] != None:
+                base = MappingIndex.base(patch['module'])
+                if base == None:
+                    continue
+                patch['addr'] = base + patch['offset']
+
+            # assemble again, pc-relative operands depend on the new address
+            code = Assembler.assemble(patch['asm'], patch['addr'], patch['mode'][0], patch['mode'][1])
+            patch['original'] = str(gdb.selected_inferior().read_memory(patch['addr'], len(code)))
+            Patches.write(patch['addr'], code)
+            patch['code'] = code
+            patch['is_applied'] = True
+            count += 1
+        return count
+
+    @staticmethod
+    def on_exited(event):
+        for patch in Patches.patches:
+            patch['is_applied'] = False
+        ModuleCache.clear_patched()
+
+
+# heap
+###############################################
+class Heap():
+    '''Allocator metadata parsed from the memory map, cached until the debuggee resumes.'''
+
+    READ_SIZE = 1024 * 1024
+    SCUDO_STATES = ('available', 'allocated', 'quarantined')
+    HEADER = struct.Struct('<Q')
+    # block sizes of scudo's AndroidSizeClassConfig (size_class_map.h), class id N uses entry N - 1
+    SCUDO_CLASSES_64 = (
+        0x00020, 0x00030, 0x00040, 0x00050, 0x00060, 0x00070, 0x00090, 0x000b0,
+        0x000c0, 0x000e0, 0x00120, 0x00160, 0x001c0, 0x00250, 0x00320, 0x00450,
+        0x00670, 0x00830, 0x00a10, 0x00c30, 0x01010, 0x01210, 0x01bd0, 0x02210,
+        0x02d90, 0x03790, 0x04010, 0x04810, 0x05a10, 0x07310, 0x08210, 0x10010)
+    SCUDO_CLASSES_32 = (
+        0x00020, 0x00030, 0x00040, 0x00050, 0x00060, 0x00070, 0x00080, 0x00090,
+        0x000a0, 0x000b0, 0x000c0, 0x000e0, 0x000f0, 0x00110, 0x00120, 0x00130,
+        0x00150, 0x00160, 0x00170, 0x00190, 0x001d0, 0x00210, 0x00240, 0x002a0,
+        0x00330, 0x00370, 0x003a0, 0x00400, 0x00430, 0x004a0, 0x00530, 0x00610,
+        0x00730, 0x00840, 0x00910, 0x009c0, 0x00a60, 0x00b10, 0x00ca0, 0x00e00,
+        0x00fb0, 0x01030, 0x01130, 0x011f0, 0x01490, 0x01650, 0x01930, 0x02010,
+        0x02190, 0x02490, 0x02850, 0x02d50, 0x03010, 0x03210, 0x03c90, 0x04090,
+        0x04510, 0x04810, 0x05c10, 0x06f10, 0x07310, 0x08010, 0x0c010, 0x10010)
+    # the 32-bit primary carves every class from its own aligned 256KB regions, which may share a mapping
+    SCUDO_REGION_SIZE_32 = 1 << 18
+    # jemalloc 4 (Android 7 - 9) arena chunks start with extent_node_t and map_bits, one word per page
+    JE_PAGE = 0x1000
+    JE_LG_CHUNK_MIN = 18
+    JE_LG_CHUNK_MAX = 22
+    JE_BININD_SHIFT = 5
+    JE_RUNIND_SHIFT = 13
+    # word offset of map_bits in 4.0 - 4.2, and in 4.3+ which added en_sn and hugepage
+    JE_MAP_OFFSETS = (13, 15)
+    # other builds are searched up to this many words
+    JE_MAX_NODE_WORDS = 32
+    JE_NODE = {4: struct.Struct('<3I'), 8: struct.Struct('<3Q')}
+
+    is_loaded = False
+    allocator = None
+    header_size = 16
+    # (user address, size, class id, state) of scudo primary chunks
+    chunks = []
+    starts = []
+    # (start, end, name) of regions that are summarized as a whole
+    regions = []
+    # (run address, size, bin index, 'small'/'large'/'free', chunk address) of jemalloc arena chunks
+    runs = []
+    run_starts = []
+    # region size of every small bin
+    bin_sizes = []
+    # pages per chunk -> word offset of map_bits
+    je_layouts = {}
+    ptr_size = 8
+    formats = {}
+
+    @staticmethod
+    def invalidate():
+        Heap.is_loaded = False
+
+    @staticmethod
+    def get_format(count, code='Q'):
+        if (count, code) not in Heap.formats:
+            Heap.formats[(count, code)] = struct.Struct('<%d%s' % (count, code))
+        return Heap.formats[(count, code)]
+
+    @staticmethod
+    def load():
+        if Heap.is_loaded:
+            return
+
+        MappingIndex.load(refresh=True)
+        Heap.chunks = []
+        Heap.regions = []
+        Heap.runs = []
+        Heap.ptr_size = gdb.lookup_type('void').pointer().sizeof
+        Heap.header_size = Heap.ptr_size * 2
+
+        primary = [region for region in MappingIndex.regions if region[4].endswith('scudo:primary]')]
+        secondary = [region for region in MappingIndex.regions if region[4].endswith('scudo:secondary]')]
+        jemalloc = [region for region in MappingIndex.regions
+                    if 'libc_malloc' in region[4] or 'jemalloc' in region[4]]
+
+        if len(primary) + len(secondary) != 0:
+            Heap.allocator = 'scudo'
+            for region in primary:
+                Heap.scan_scudo(region[0], region[1])
+            Heap.regions = [(region[0], region[1], 'secondary') for region in secondary]
+        elif len(jemalloc) != 0:
+            Heap.allocator = 'jemalloc'
+            Heap.bin_sizes = Heap.get_bin_sizes(4 if Heap.ptr_size == 8 else 3)
+            for region in jemalloc:
+                Heap.scan_jemalloc(region[0], region[1], os.path.basename(region[4]))
+        else:
+            Heap.allocator = None
+
+        Heap.chunks.sort()
+        Heap.starts = [chunk[0] for chunk in Heap.chunks]
+        Heap.runs.sort()
+        Heap.run_starts = [run[0] for run in Heap.runs]
+        Heap.is_loaded = True
+
+    @staticmethod
+    def parse_header(header):
+        # packed header: class id:8, state:2, origin:2, size:20, offset:16, checksum:16
+        return (header & 0xff, (header >> 8) & 0x3, (header >> 12) & 0xfffff, (header >> 32) & 0xffff)
+
+    @staticmethod
+    def get_block_size(class_id):
+        classes = Heap.SCUDO_CLASSES_64 if Heap.header_size == 16 else Heap.SCUDO_CLASSES_32
+        if 1 <= class_id <= len(classes):
+            return classes[class_id - 1]
+        return None
+
+    @staticmethod
+    def is_chunk(header, class_id, block_size):
+        '''Freed chunks keep their header with the available state, blocks never handed out are zero.'''
+        if header == 0:
+            return False
+
+        header_class, state, size, offset = Heap.parse_header(header)
+        return header_class == class_id and state != 3 and offset == 0 and size + Heap.header_size <= block_size
+
+    @staticmethod
+    def scan_scudo(start, end):
+        if Heap.header_size == 16:
+            Heap.scan_scudo_region(start, start, end)
+            return
+
+        step = Heap.SCUDO_REGION_SIZE_32
+        for base in xrange(start - start % step, end, step):
+            Heap.scan_scudo_region(base, max(base, start), min(base + step, end))
+
+    @staticmethod
+    def scan_scudo_region(base, start, end):
+        '''Blocks of a single class are laid out from base, the class comes from the first header found.'''
+        size = min(Heap.READ_SIZE, end - start) & ~7
+        try:
+            words = Heap.get_format(size / 8).unpack_from(str(gdb.selected_inferior().read_memory(start, size)))
+        except gdb.MemoryError:
+            return
+
+        # a header only counts on a block boundary of its own class, user data rarely lines up with one
+        for idx in xrange(0, len(words), Heap.header_size / 8):
+            class_id = words[idx] & 0xff
+            block = Heap.get_block_size(class_id)
+            if block != None and (start + idx * 8 - base) % block == 0 and \
+                    Heap.is_chunk(words[idx], class_id, block):
+                break
+        else:
+            return
+
+        # walk block boundaries, the bulk reads bypass MemoryCache
+        pos = start + idx * 8
+        while pos + Heap.HEADER.size <= end:
+            count = max(1, min(Heap.READ_SIZE, end - pos) / block)
+            length = min(count * block, end - pos)
+            try:
+                data = str(gdb.selected_inferior().read_memory(pos, length))
+            except gdb.MemoryError:
+                pos += count * block
+                continue
+
+            for offset in xrange(0, length - Heap.HEADER.size + 1, block):
+                header = Heap.HEADER.unpack_from(data, offset)[0]
+                if Heap.is_chunk(header, class_id, block):
+                    _, state, chunk_size, _ = Heap.parse_header(header)
+                    Heap.chunks.append((pos + offset + Heap.header_size, chunk_size, class_id, state))
+            pos += count * block
+
+    @staticmethod
+    def get_bin_sizes(lg_quantum):
+        '''Small size classes of jemalloc 4 with 4KB pages: quantum spaced, then four per doubling below 16KB.'''
+        sizes = [1 << lg for lg in xrange(3, lg_quantum)]
+        sizes += [n << lg_quantum for n in xrange(1, 5)]
+        base = 4 << lg_quantum
+        while True:
+            for n in xrange(1, 5):
+                size = base + n * base / 4
+                if size >= 4 * Heap.JE_PAGE:
+                    return sizes
+                sizes.append(size)
+            base *= 2
+
+    @staticmethod
+    def scan_jemalloc(start, end, name):
+        '''Parse the arena chunks of a region, huge allocations have no header and are listed as regions.'''
+        node = Heap.JE_NODE[Heap.ptr_size]
+        words = Heap.get_format(Heap.JE_MAX_NODE_WORDS + (1 << (Heap.JE_LG_CHUNK_MAX - 12)),
+                                'Q' if Heap.ptr_size == 8 else 'I')
+        inferior = gdb.selected_inferior()
+        step = 1 << Heap.JE_LG_CHUNK_MIN
+        runs = []
+        huge = []
+        pos = start
+        while pos < end:
+            chunk = None
+            try:
+                # extent_node_t begins with arena, chunk address and chunk size
+                _, addr, size = node.unpack_from(str(inferior.read_memory(pos, node.size)))
+                if addr == pos and size & (size - 1) == 0 and \
+                        1 << Heap.JE_LG_CHUNK_MIN <= size <= 1 << Heap.JE_LG_CHUNK_MAX and pos + size <= end:
+                    header = words.unpack_from(str(inferior.read_memory(pos, words.size)))
+                    chunk = Heap.parse_arena_chunk(pos, size, header)
+            except gdb.MemoryError:
+                pass
+
+            if chunk == None:
+                # chunks are aligned to their size, skip to the next boundary
+                next_pos = pos - pos % step + step
+                if len(huge) != 0 and huge[-1][1] == pos:
+                    huge[-1][1] = next_pos
+                else:
+                    huge.append([pos, next_pos])
+                pos = next_pos
+                continue
+
+            runs.extend(chunk)
+            step = size
+            pos += size
+
+        # jemalloc 3 and 5 keep no chunk headers of this layout
+        if len(runs) == 0:
+            Heap.regions.append((start, end, name))
+            return
+
+        Heap.runs.extend(runs)
+        Heap.regions.extend([(huge_start, min(huge_end, end), 'huge') for huge_start, huge_end in huge])
+
+    @staticmethod
+    def parse_arena_chunk(base, size, words):
+        npages = size / Heap.JE_PAGE
+        # a node word of 1 reads as a one page small run, so known layouts go before the search
+        offsets = list(Heap.JE_MAP_OFFSETS) + range(3, Heap.JE_MAX_NODE_WORDS)
+        if npages in Heap.je_layouts:
+            offsets.insert(0, Heap.je_layouts[npages])
+
+        for offset in offsets:
+            runs = Heap.walk_map_bits(base, npages, words, offset)
+            if runs != None:
+                Heap.je_layouts[npages] = offset
+                return runs
+        return None
+
+    @staticmethod
+    def walk_map_bits(base, npages, words, offset):
+        '''Decode map_bits starting at a word offset, None unless the runs tile the chunk after its header.'''
+        runs = []
+        page = 0
+        while offset + page < len(words) and page < npages - 1:
+            bits = words[offset + page]
+            state = bits & 0x3
+            if state == 1:
+                # small run: bin index, and the page offset inside the run on each of its pages
+                binind = (bits >> Heap.JE_BININD_SHIFT) & 0xff
+                if binind >= len(Heap.bin_sizes) or bits >> Heap.JE_RUNIND_SHIFT != 0:
+                    break
+                count = 1
+                while offset + page + count < len(words) and words[offset + page + count] & 0x3 == 1 and \
+                        (words[offset + page + count] >> Heap.JE_BININD_SHIFT) & 0xff == binind and \
+                        words[offset + page + count] >> Heap.JE_RUNIND_SHIFT == count:
+                    count += 1
+                runs.append((page, count, binind, 'small'))
+            elif state != 2:
+                # large or unallocated run: its size is stored on its first page shifted left by one,
+                # which with 4KB pages leaves the page count above the run index shift
+                count = bits >> Heap.JE_RUNIND_SHIFT
+                if count == 0:
+                    break
+                runs.append((page, count, None, 'large' if state == 3 else 'free'))
+            else:
+                break
+            page += count
+
+        # the map ends where the header pages, which must hold it, end
+        for idx in xrange(len(runs), 0, -1):
+            mapped = runs[idx - 1][0] + runs[idx - 1][1]
+            bias = npages - mapped
+            if bias >= 1 and bias * Heap.JE_PAGE >= (offset + mapped) * Heap.ptr_size:
+                return [(base + (bias + page) * Heap.JE_PAGE, count * Heap.JE_PAGE, binind, kind, base)
+                        for page, count, binind, kind in runs[:idx]]
+        return None
+
+    @staticmethod
+    def jemalloc_summary():
+        '''Return {bin index: [runs, regions, bytes]} of small runs and {'large'/'free': [runs, bytes]}.'''
+        bins = {}
+        others = {'large': [0, 0], 'free': [0, 0]}
+        for _, size, binind, kind, _ in Heap.runs:
+            if kind == 'small':
+                item = bins.setdefault(binind, [0, 0, 0])
+                item[0] += 1
+                item[1] += size / Heap.bin_sizes[binind]
+                item[2] += size
+            else:
+                others[kind][0] += 1
+                others[kind][1] += size
+        return bins, others
+
+    @staticmethod
+    def find_run(addr):
+        idx = bisect.bisect_right(Heap.run_starts, addr) - 1
+        if idx >= 0 and addr < Heap.runs[idx][0] + Heap.runs[idx][1]:
+            return Heap.runs[idx]
+        return None
+
+    @staticmethod
+    def summary():
+        '''Return {class id: [available, allocated, quarantined, requested bytes in use, min size, max size]}.'''
+        result = {}
+        for _, size, class_id, state in Heap.chunks:
+            item = result.setdefault(class_id, [0, 0, 0, 0, size, size])
+            item[state] += 1
+            if state != 0:
+                item[3] += size
+            item[4] = min(item[4], size)
+            item[5] = max(item[5], size)
+        return result
+
+    @staticmethod
+    def find(addr):
+        idx = bisect.bisect_right(Heap.starts, addr) - 1
+        if idx >= 0:
+            chunk = Heap.chunks[idx]
+            if addr < chunk[0] + chunk[1]:
+                return chunk
+        # the header in front of the user data belongs to the chunk too
+        if idx + 1 < len(Heap.chunks) and Heap.chunks[idx + 1][0] - Heap.header_size <= addr:
+            return Heap.chunks[idx + 1]
+        return None
+
+
+# commands
+###############################################
+class MappingCommand(gdb.Command):
+    '''List of mapped memory regions.'''
+
+    def __init__(self):
+        gdb.Command.__init__(self, 'vmmap', gdb.COMMAND_RUNNING, prefix=True)
+        self.init_subcommands()
+
+    def init_subcommands(self):
+        MappingCommand.MappingFilterCommand()
+
+    def invoke(self, args, from_tty):
+        try:
+            mapping = Strongdb.run_cmd('info proc mapping')
+            Strongdb.display(mapping)
+        except Exception, e:
+            print e
+            return
+
+    # subcommands
+
+    class MappingFilterCommand(gdb.Command):
+        '''Memory region of specific module'''
+
+        def __init__(self):
+            gdb.Command.__init__(self, 'vmmap -f', gdb.COMMAND_NONE)
+
+        def invoke(self, args, from_tty):
+            argv = gdb.string_to_argv(args)
+            result = []
+
+            if len(argv) != 1:
+                raise gdb.GdbError('vmmap -f takes 1 arg')
+
+            try:
+                mapping = Strongdb.run_cmd('info proc mapping')
+                mapping = mapping[mapping.find('0x'):].split('\n')
+
+                for item in mapping:
+                    item_list = item.split(None)
+
+                    if len(item_list) == 5 and item_list[4].find(argv[0]) != -1:
+                        result.append('\t\t'.join(item_list))
+
+                Strongdb.display('\n'.join(result) + '\n\n')
+            except Exception, e:
+                print e
+                return
+
+
+class ColorCommand(gdb.Command):
+    '''Set views color'''
+
+    def __init__(self):
+        gdb.Command.__init__(self, 'color', gdb.COMMAND_USER, prefix=True)
+        self.init_subcommands()
+
+    def init_subcommands(self):
+        ColorCommand.ColorBorderCommand()
+        ColorCommand.ColorRegNameCommand()
         ColorCommand.ColorRegValueCommand()
         ColorCommand.ColorRegValueHighlightCommand()
         ColorCommand.ColorAddressCommand()
@@ -818,6 +2812,558 @@ class ColorCommand(gdb.Command):
             Strongdb.display('valid color: ' + ','.join(Colors.COLORS.keys()) + '\n\n', color='green')
 
 
+class CacheCommand(gdb.Command):
+    '''Show the per-library analysis cache'''
+
+    def __init__(self):
+        gdb.Command.__init__(self, 'cache', gdb.COMMAND_USER, prefix=True)
+        self.init_subcommands()
+
+    def init_subcommands(self):
+        CacheCommand.CacheSaveCommand()
+        CacheCommand.CacheClearCommand()
+
+    def invoke(self, args, from_tty):
+        result = ['cache dir: %s (limit %d bytes)' % (ModuleCache.root, ModuleCache.get_limit())]
+        for name in sorted(ModuleCache.entries.keys()):
+            entry = ModuleCache.entries[name]
+            result.append('\t%s\t%s\t%d symbols\t%d insns' % (
+                name, entry.key, entry.sym_count, entry.dis_count + len(entry.new_disasm)))
+
+        Strongdb.display('\n'.join(result) + '\n\n')
+
+    # subcommands
+
+    class CacheSaveCommand(gdb.Command):
+        '''Write cached disassembly to disk'''
+
+        def __init__(self):
+            gdb.Command.__init__(self, 'cache save', gdb.COMMAND_USER)
+
+        def invoke(self, args, from_tty):
+            ModuleCache.flush()
+
+    class CacheClearCommand(gdb.Command):
+        '''Remove all cache files'''
+
+        def __init__(self):
+            gdb.Command.__init__(self, 'cache clear', gdb.COMMAND_USER)
+
+        def invoke(self, args, from_tty):
+            ModuleCache.clear()
+
+
+class SampleCommand(gdb.Command):
+    '''Sample all threads periodically'''
+
+    def __init__(self):
+        gdb.Command.__init__(self, 'sample', gdb.COMMAND_RUNNING, prefix=True)
+        self.init_subcommands()
+
+    def init_subcommands(self):
+        SampleCommand.SampleStartCommand()
+        SampleCommand.SampleStopCommand()
+        SampleCommand.SampleReportCommand()
+        SampleCommand.SampleFoldedCommand()
+
+    def invoke(self, args, from_tty):
+        gdb.execute('sample report ' + args, from_tty)
+
+    # subcommands
+
+    class SampleStartCommand(gdb.Command):
+        '''Start sampling: sample start [-r rate] [-n samples] [-d depth] [-a]'''
+
+        def __init__(self):
+            gdb.Command.__init__(self, 'sample start', gdb.COMMAND_RUNNING)
+
+        def invoke(self, args, from_tty):
+            argv = gdb.string_to_argv(args)
+            options = {'-r': 20, '-n': 200, '-d': 16}
+            append = False
+
+            i = 0
+            while i < len(argv):
+                if argv[i] == '-a':
+                    append = True
+                elif argv[i] in options and i + 1 < len(argv) and argv[i + 1].isdigit():
+                    options[argv[i]] = int(argv[i + 1])
+                    i += 1
+                else:
+                    raise gdb.GdbError('invalid argument ' + argv[i])
+                i += 1
+
+            if Sampler.is_running:
+                raise gdb.GdbError('sampling is already running')
+            if options['-r'] == 0 or options['-n'] == 0 or options['-d'] == 0:
+                raise gdb.GdbError('rate, samples and depth must be positive')
+
+            if not append:
+                Sampler.reset()
+            Sampler.start(options['-r'], options['-n'], options['-d'])
+
+    class SampleStopCommand(gdb.Command):
+        '''Stop sampling'''
+
+        def __init__(self):
+            gdb.Command.__init__(self, 'sample stop', gdb.COMMAND_RUNNING)
+
+        def invoke(self, args, from_tty):
+            if not Sampler.is_running:
+                return
+            Sampler.stop()
+            gdb.execute('interrupt')
+
+    class SampleReportCommand(gdb.Command):
+        '''Display the hottest symbols: sample report [N]'''
+
+        def __init__(self):
+            gdb.Command.__init__(self, 'sample report', gdb.COMMAND_RUNNING)
+
+        def invoke(self, args, from_tty):
+            argv = gdb.string_to_argv(args)
+
+            if len(argv) > 1 or (len(argv) == 1 and not argv[0].isdigit()):
+                raise gdb.GdbError('sample report takes an optional count')
+
+            if Sampler.samples == 0:
+                Strongdb.display('no samples\n')
+                return
+
+            result = ['%d samples' % Sampler.samples, '\t   self   total  symbol']
+            for name, self_count, inclusive in Sampler.top(int(argv[0]) if len(argv) == 1 else 20):
+                result.append('\t%6.2f%% %6.2f%%  %s' % (self_count * 100.0 / Sampler.samples,
+                                                          inclusive * 100.0 / Sampler.samples, name))
+
+            Strongdb.display('\n'.join(result) + '\n\n')
+
+    class SampleFoldedCommand(gdb.Command):
+        '''Write folded stacks for flamegraph.pl: sample folded FILE'''
+
+        def __init__(self):
+            gdb.Command.__init__(self, 'sample folded', gdb.COMMAND_RUNNING)
+
+        def invoke(self, args, from_tty):
+            argv = gdb.string_to_argv(args)
+
+            if len(argv) != 1:
+                raise gdb.GdbError('sample folded takes 1 arg')
+
+            try:
+                with open(os.path.expanduser(argv[0]), 'w') as f:
+                    for line in Sampler.folded():
+                        f.write(line + '\n')
+            except IOError, e:
+                raise gdb.GdbError(str(e))
+
+
+class CoverageCommand(gdb.Command):
+    '''Collect basic block coverage of a module: coverage MODULE'''
+
+    def __init__(self):
+        gdb.Command.__init__(self, 'coverage', gdb.COMMAND_RUNNING, prefix=True)
+        self.init_subcommands()
+
+    def init_subcommands(self):
+        CoverageCommand.CoverageStopCommand()
+        CoverageCommand.CoverageExportCommand()
+
+    def invoke(self, args, from_tty):
+        argv = gdb.string_to_argv(args)
+
+        if len(argv) > 1:
+            raise gdb.GdbError('coverage takes 1 arg')
+
+        if len(argv) == 1:
+            Coverage.start(argv[0])
+
+        if Coverage.name == None:
+            Strongdb.display('no coverage collected\n')
+            return
+
+        Strongdb.display('%s: %d/%d basic blocks hit, %d breakpoints armed, %d waiting\n' % (
+            Coverage.name, Coverage.hit_count, len(Coverage.blocks), len(Coverage.breakpoints),
+            len(Coverage.blocks) - Coverage.installed))
+
+    # subcommands
+
+    class CoverageStopCommand(gdb.Command):
+        '''Remove coverage breakpoints, keeping the hits'''
+
+        def __init__(self):
+            gdb.Command.__init__(self, 'coverage stop', gdb.COMMAND_RUNNING)
+
+        def invoke(self, args, from_tty):
+            Coverage.stop()
+
+    class CoverageExportCommand(gdb.Command):
+        '''Write hit basic blocks in drcov format: coverage export FILE'''
+
+        def __init__(self):
+            gdb.Command.__init__(self, 'coverage export', gdb.COMMAND_RUNNING)
+
+        def invoke(self, args, from_tty):
+            argv = gdb.string_to_argv(args)
+
+            if len(argv) != 1:
+                raise gdb.GdbError('coverage export takes 1 arg')
+
+            if Coverage.name == None:
+                raise gdb.GdbError('no coverage collected, see "coverage MODULE"')
+
+            try:
+                Coverage.export(os.path.expanduser(argv[0]))
+            except IOError, e:
+                raise gdb.GdbError(str(e))
+
+
+class ThreadsCommand(gdb.Command):
+    '''List all threads with their pc and symbol'''
+
+    def __init__(self):
+        gdb.Command.__init__(self, 'threads', gdb.COMMAND_STACK)
+
+    def invoke(self, args, from_tty):
+        if gdb.selected_inferior().pid == 0:
+            raise gdb.GdbError('the program is not being run')
+
+        Strongdb.display(Strongdb.modules['ThreadsModule'].get_contents() + '\n')
+
+
+class ModuleBreakpointCommand(gdb.Command):
+    '''Break at library+offset, also before the library is loaded: bmod LIB OFFSET'''
+
+    def __init__(self):
+        gdb.Command.__init__(self, 'bmod', gdb.COMMAND_BREAKPOINTS, prefix=True)
+        self.init_subcommands()
+
+    def init_subcommands(self):
+        ModuleBreakpointCommand.ModuleBreakpointDeleteCommand()
+
+    def invoke(self, args, from_tty):
+        argv = gdb.string_to_argv(args)
+
+        if len(argv) == 2:
+            try:
+                offset = int(argv[1], 0)
+            except ValueError:
+                raise gdb.GdbError('invalid offset ' + argv[1])
+            ModuleBreakpoints.add(argv[0], offset)
+        elif len(argv) != 0:
+            raise gdb.GdbError('bmod takes 2 args')
+
+        result = []
+        for name in sorted(ModuleBreakpoints.pending.keys()):
+            for entry in ModuleBreakpoints.pending[name]:
+                if entry['bp'] != None and entry['bp'].is_valid():
+                    status = 'breakpoint %d at %s' % (entry['bp'].number, entry['bp'].location[1:])
+                else:
+                    status = 'pending'
+                result.append('\t%d\t%s+%#x\t%s' % (entry['id'], name, entry['offset'], status))
+
+        Strongdb.display('\n'.join(result) + '\n\n')
+
+    # subcommands
+
+    class ModuleBreakpointDeleteCommand(gdb.Command):
+        '''Delete a module breakpoint: bmod delete ID'''
+
+        def __init__(self):
+            gdb.Command.__init__(self, 'bmod delete', gdb.COMMAND_BREAKPOINTS)
+
+        def invoke(self, args, from_tty):
+            argv = gdb.string_to_argv(args)
+
+            if len(argv) != 1 or not argv[0].isdigit():
+                raise gdb.GdbError('bmod delete takes 1 arg')
+
+            if not ModuleBreakpoints.delete(int(argv[0])):
+                raise gdb.GdbError('no module breakpoint ' + argv[0])
+
+
+class SnapshotCommand(gdb.Command):
+    '''Stream one record per stop instead of displaying the views'''
+
+    def __init__(self):
+        gdb.Command.__init__(self, 'snapshot', gdb.COMMAND_USER, prefix=True)
+        self.init_subcommands()
+
+    def init_subcommands(self):
+        SnapshotCommand.SnapshotFileCommand()
+        SnapshotCommand.SnapshotUnixCommand()
+        SnapshotCommand.SnapshotOffCommand()
+
+    def invoke(self, args, from_tty):
+        if SnapshotStream.output == None:
+            Strongdb.display('snapshot stream off\n')
+        else:
+            Strongdb.display('snapshot stream: %s (%s), %d records\n' % (
+                SnapshotStream.target, SnapshotStream.format, SnapshotStream.count))
+
+    @staticmethod
+    def parse_args(name, args):
+        argv = gdb.string_to_argv(args)
+
+        if len(argv) == 1:
+            return (os.path.expanduser(argv[0]), 'json')
+        if len(argv) == 2 and argv[1] in ('json', 'bin'):
+            return (os.path.expanduser(argv[0]), argv[1])
+        raise gdb.GdbError('snapshot %s takes PATH [json|bin]' % name)
+
+    # subcommands
+
+    class SnapshotFileCommand(gdb.Command):
+        '''Append records to a file: snapshot file PATH [json|bin]'''
+
+        def __init__(self):
+            gdb.Command.__init__(self, 'snapshot file', gdb.COMMAND_USER)
+
+        def invoke(self, args, from_tty):
+            path, fmt = SnapshotCommand.parse_args('file', args)
+
+            try:
+                SnapshotStream.open(path, fmt, False)
+            except IOError, e:
+                raise gdb.GdbError(str(e))
+
+    class SnapshotUnixCommand(gdb.Command):
+        '''Send records to a unix socket: snapshot unix PATH [json|bin]'''
+
+        def __init__(self):
+            gdb.Command.__init__(self, 'snapshot unix', gdb.COMMAND_USER)
+
+        def invoke(self, args, from_tty):
+            path, fmt = SnapshotCommand.parse_args('unix', args)
+
+            try:
+                SnapshotStream.open(path, fmt, True)
+            except socket.error, e:
+                SnapshotStream.close()
+                raise gdb.GdbError(str(e))
+
+    class SnapshotOffCommand(gdb.Command):
+        '''Stop streaming and display the views again'''
+
+        def __init__(self):
+            gdb.Command.__init__(self, 'snapshot off', gdb.COMMAND_USER)
+
+        def invoke(self, args, from_tty):
+            SnapshotStream.close()
+
+
+class PatchCommand(gdb.Command):
+    '''Assemble and write code: patch [-a|-t] ADDR "asm; asm"'''
+
+    def __init__(self):
+        gdb.Command.__init__(self, 'patch', gdb.COMMAND_DATA, prefix=True)
+        self.init_subcommands()
+
+    def init_subcommands(self):
+        PatchCommand.PatchUndoCommand()
+        PatchCommand.PatchReplayCommand()
+
+    def invoke(self, args, from_tty):
+        argv = gdb.string_to_argv(args)
+        is_thumb = None
+
+        if len(argv) != 0 and argv[0] in ('-a', '-t'):
+            is_thumb = argv[0] == '-t'
+            argv = argv[1:]
+
+        if len(argv) == 2:
+            addr = int(gdb.parse_and_eval(argv[0])) & 0xffffffffffffffff
+            try:
+                patch = Patches.apply(addr, argv[1], Assembler.get_mode(is_thumb))
+            except KsError, e:
+                raise gdb.GdbError('cannot assemble "%s": %s' % (argv[1], e))
+            except gdb.MemoryError, e:
+                raise gdb.GdbError(str(e))
+            Strongdb.display('patched %d bytes at %#x\n' % (len(patch['code']), patch['addr']))
+            return
+        elif len(argv) != 0:
+            raise gdb.GdbError('patch takes ADDR "asm; asm"')
+
+        result = []
+        for patch in Patches.patches:
+            where = '%s+%#x' % (patch['module'], patch['offset']) if patch['module'] != None else '%#x' % patch['addr']
+            result.append('\t%d\t%s\t%s\t%s -> %s\t%s' % (
+                patch['id'], where, patch['asm'], patch['original'].encode('hex'), patch['code'].encode('hex'),
+                'applied' if patch['is_applied'] else 'pending'))
+
+        Strongdb.display('\n'.join(result) + '\n\n')
+
+    # subcommands
+
+    class PatchUndoCommand(gdb.Command):
+        '''Restore the original bytes: patch undo ID'''
+
+        def __init__(self):
+            gdb.Command.__init__(self, 'patch undo', gdb.COMMAND_DATA)
+
+        def invoke(self, args, from_tty):
+            argv = gdb.string_to_argv(args)
+
+            if len(argv) != 1 or not argv[0].isdigit():
+                raise gdb.GdbError('patch undo takes 1 arg')
+
+            if not Patches.undo(int(argv[0])):
+                raise gdb.GdbError('no patch ' + argv[0])
+
+    class PatchReplayCommand(gdb.Command):
+        '''Re-apply patches after the app restarted'''
+
+        def __init__(self):
+            gdb.Command.__init__(self, 'patch replay', gdb.COMMAND_DATA)
+
+        def invoke(self, args, from_tty):
+            try:
+                count = Patches.replay()
+            except (KsError, gdb.MemoryError), e:
+                raise gdb.GdbError(str(e))
+            Strongdb.display('%d patches applied\n' % count)
+
+
+class HeapCommand(gdb.Command):
+    '''Summarize the native heap, or show the chunk holding ADDR: heap [ADDR]
+
+Scudo primary chunks and jemalloc 4 runs are listed per size class. Scudo
+secondary memory, jemalloc huge allocations and jemalloc 3/5 heaps are listed
+per region.'''
+
+    def __init__(self):
+        gdb.Command.__init__(self, 'heap', gdb.COMMAND_DATA)
+
+    def invoke(self, args, from_tty):
+        argv = gdb.string_to_argv(args)
+
+        if len(argv) > 1:
+            raise gdb.GdbError('heap takes an optional address')
+
+        Heap.load()
+        if Heap.allocator == None:
+            raise gdb.GdbError('no scudo or jemalloc regions in the memory map')
+
+        if len(argv) == 1:
+            self.show_chunk(int(gdb.parse_and_eval(argv[0])) & 0xffffffffffffffff)
+        else:
+            self.show_summary()
+
+    def show_summary(self):
+        result = ['allocator: ' + Heap.allocator]
+
+        if Heap.allocator == 'jemalloc':
+            self.show_bins(result)
+
+        summary = Heap.summary()
+        if len(summary) != 0:
+            result.append('\tclass\tblock\tavailable\tallocated\tquarantined\tbytes\t\tsizes')
+        for class_id in sorted(summary.keys()):
+            available, allocated, quarantined, total, min_size, max_size = summary[class_id]
+            result.append('\t%d\t%d\t%d\t\t%d\t\t%d\t\t%d\t\t%d-%d' % (
+                class_id, Heap.get_block_size(class_id), available, allocated, quarantined, total, min_size,
+                max_size))
+
+        for start, end, name in Heap.regions:
+            result.append('\t%s - %s\t%d bytes\t%s' % (
+                Strongdb.colorize('%#x' % start, Colors.address_color),
+                Strongdb.colorize('%#x' % end, Colors.address_color), end - start, name))
+
+        Strongdb.display('\n'.join(result) + '\n\n')
+
+    def show_bins(self, result):
+        bins, others = Heap.jemalloc_summary()
+        if len(bins) != 0:
+            result.append('\tbin\tsize\truns\tregions\t\tbytes')
+        for binind in sorted(bins.keys()):
+            runs, regions, total = bins[binind]
+            result.append('\t%d\t%d\t%d\t%d\t\t%d' % (binind, Heap.bin_sizes[binind], runs, regions, total))
+        for kind in ('large', 'free'):
+            if others[kind][0] != 0:
+                result.append('\t%s runs: %d, %d bytes' % (kind, others[kind][0], others[kind][1]))
+
+    def show_run(self, addr, run):
+        start, size, binind, kind, chunk = run
+        if kind == 'small':
+            region = start + (addr - start) / Heap.bin_sizes[binind] * Heap.bin_sizes[binind]
+            Strongdb.display('%#x: region %s, %d bytes, bin %d, run %#x (%d bytes), chunk %#x\n' % (
+                addr, Strongdb.colorize('%#x' % region, Colors.address_color), Heap.bin_sizes[binind], binind,
+                start, size, chunk))
+        else:
+            Strongdb.display('%#x: %s run %s, %d bytes, chunk %#x\n' % (
+                addr, kind, Strongdb.colorize('%#x' % start, Colors.address_color), size, chunk))
+
+    def show_chunk(self, addr):
+        run = Heap.find_run(addr)
+        if run != None:
+            self.show_run(addr, run)
+            return
+
+        chunk = Heap.find(addr)
+        if chunk != None:
+            Strongdb.display('%#x: chunk %s, %d bytes, class %d, %s\n' % (
+                addr, Strongdb.colorize('%#x' % chunk[0], Colors.address_color), chunk[1], chunk[2],
+                Heap.SCUDO_STATES[chunk[3]]))
+            return
+
+        for start, end, name in Heap.regions:
+            if start <= addr < end:
+                Strongdb.display('%#x: in %s region %#x - %#x\n' % (addr, name, start, end))
+                return
+
+        Strongdb.display('%#x: not in a known heap chunk\n' % addr)
+
+
+class WatchExprCommand(gdb.Command):
+    '''Add an expression to the watch view: watch-expr EXPR'''
+
+    def __init__(self):
+        gdb.Command.__init__(self, 'watch-expr', gdb.COMMAND_DATA, prefix=True)
+        self.init_subcommands()
+
+    def init_subcommands(self):
+        WatchExprCommand.WatchExprDeleteCommand()
+        WatchExprCommand.WatchExprClearCommand()
+
+    def invoke(self, args, from_tty):
+        if args.strip() != '':
+            WatchModule.add(args.strip())
+
+        result = []
+        for idx in range(len(WatchModule.watches)):
+            watch = WatchModule.watches[idx]
+            result.append('\t%d: %s%s' % (idx + 1, watch['expr'], '' if watch['plan'] != None else '\t(gdb)'))
+
+        Strongdb.display('\n'.join(result) + '\n\n')
+
+    # subcommands
+
+    class WatchExprDeleteCommand(gdb.Command):
+        '''Remove a watch expression: watch-expr delete N'''
+
+        def __init__(self):
+            gdb.Command.__init__(self, 'watch-expr delete', gdb.COMMAND_DATA)
+
+        def invoke(self, args, from_tty):
+            argv = gdb.string_to_argv(args)
+
+            if len(argv) != 1 or not argv[0].isdigit():
+                raise gdb.GdbError('watch-expr delete takes 1 arg')
+
+            idx = int(argv[0]) - 1
+            if idx < 0 or idx >= len(WatchModule.watches):
+                raise gdb.GdbError('no watch expression ' + argv[0])
+            del WatchModule.watches[idx]
+
+    class WatchExprClearCommand(gdb.Command):
+        '''Remove all watch expressions'''
+
+        def __init__(self):
+            gdb.Command.__init__(self, 'watch-expr clear', gdb.COMMAND_DATA)
+
+        def invoke(self, args, from_tty):
+            WatchModule.watches = []
+
+
 class SetJniEnvCommand(gdb.Command):
     '''Set jnienv address to $sgdb_jnienv'''
 